@@ -0,0 +1,50 @@
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+# Startup time of inpainter.py
+# Starts `inpainter.py --startup_only` with a fresh graph cache (the graph
+# is built and saved) and then again with the same cache (the graph is
+# imported), and prints the time to a restored model of every run. Extra
+# arguments go to inpainter.py, e.g.
+#     python bench_startup.py --dataset xxx1 --dataset2 xxx2 --checkpointDir checkpoint
+
+RUNS = 3
+
+
+def run(args):
+    start = time.time()
+    output = subprocess.check_output(
+        [sys.executable, 'inpainter.py', '--startup_only'] + args,
+        stderr=subprocess.STDOUT).decode('utf-8', 'replace')
+    wall = time.time() - start
+    startup = re.search(r'imports ([\d.]+)s, graph ([\d.]+)s', output)
+    restore = re.search(r'restore ([\d.]+)s', output)
+    if startup is None or restore is None:
+        sys.stdout.write(output)
+        raise Exception("[!!!] inpainter.py did not report its startup")
+    return wall, float(startup.group(1)), float(startup.group(2)), \
+        float(restore.group(1))
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(here)
+    cache = tempfile.mkdtemp(prefix='graph_cache_')
+    args = sys.argv[1:] + ['--graph_cache={}'.format(cache)]
+    try:
+        print("{:8s} {:>8s} {:>8s} {:>8s} {:>8s}".format(
+            'run', 'total', 'imports', 'graph', 'restore'))
+        for i in range(RUNS):
+            name = 'cold' if i == 0 else 'cached'
+            print("{:8s} {:7.2f}s {:7.2f}s {:7.2f}s {:7.2f}s".format(
+                name, *run(args)))
+    finally:
+        shutil.rmtree(cache)
+
+if __name__ == '__main__':
+    main()
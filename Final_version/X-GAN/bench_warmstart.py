@@ -0,0 +1,101 @@
+import os
+import numpy as np
+import tensorflow as tf
+from glob import glob
+
+# Imported for its flag definitions only: the benchmark takes the same
+# flags as inpainter.py and reads them through tf.app.flags.FLAGS
+import inpainter
+from model import DCGAN
+from masks import make_masks
+from latents import initial_zhats
+from utils import get_image
+from convergence import PlateauTracker
+
+# Loss-vs-iteration curves of random and warm started inpainting
+# Runs the same images and masks from each start for nIter iterations and
+# writes the mean best contextual loss every 50 iterations to
+# outDir/warmstart_curves.csv. "cached" continues from the best z of the
+# masked run, i.e. what a --latent_cache hit starts from.
+#
+# Takes the inpainter.py flags, e.g.
+#     python bench_warmstart.py --dataset xxx1 --dataset2 xxx2 --imgs xxx_test --nIter 1000 --maskType center
+
+flags = tf.app.flags
+
+flags.DEFINE_integer(flag_name="bench_images", default_value=64,
+                     docstring="Images inpainted from every start [64]")
+
+FLAGS = flags.FLAGS
+
+
+class LossCurve(object):
+    """Stands in for InpaintSnapshot, records the loss instead of grids"""
+
+    def __init__(self):
+        self.iters = []
+        self.losses = []
+        self.best = None
+
+    def save(self, i, loss, ctx_loss, G_imgs):
+        self.best = ctx_loss if self.best is None else \
+            np.minimum(self.best, ctx_loss)
+        self.iters.append(i)
+        self.losses.append(float(np.mean(self.best)))
+
+
+def main(_):
+    if not FLAGS.input_width:
+        FLAGS.input_width = FLAGS.input_height
+    os.makedirs(FLAGS.outDir, exist_ok=True)
+
+    with tf.Session() as sess:
+        dcgan = DCGAN(sess,
+                      input_width=FLAGS.input_width,
+                      input_height=FLAGS.input_height,
+                      c_dim=FLAGS.c_dim,
+                      dataset_name=FLAGS.dataset,
+                      is_crop=FLAGS.is_crop,
+                      checkpoint_dir=FLAGS.checkpointDir,
+                      lambda_val=FLAGS.lambda_val,
+                      dataset_name2=FLAGS.dataset2)
+        tf.global_variables_initializer().run()
+        assert(dcgan.load(FLAGS.checkpointDir)[0])
+
+        files = sorted(glob(os.path.join(FLAGS.imgs, '*.jpg')))
+        files = files[:min(FLAGS.bench_images, dcgan.batch_size)]
+        images = np.array([get_image(f, dcgan.image_size, dcgan.image_size,
+                                     is_crop=dcgan.is_crop)
+                           for f in files]).astype(np.float32)
+        masks = make_masks(FLAGS.maskType, len(files), dcgan.image_shape,
+                           seed=max(0, FLAGS.mask_seed))
+
+        curves = {}
+        best_zhats = None
+        for init in ['random', 'masked', 'cached']:
+            np.random.seed(0)
+            if init == 'cached':
+                zhats = best_zhats
+            else:
+                zhats = initial_zhats(init, images, masks, dcgan.z_dim)
+            curve = LossCurve()
+            plateau = PlateauTracker(len(files), 1, 0, 0.0)
+            _, zs = dcgan.inpaint_batch(FLAGS, zhats, images, masks,
+                                        plateau, curve)
+            if init == 'masked':
+                best_zhats = zs
+            curves[init] = curve
+            print(" [*] {:>7s} start: loss {:.2f} at 0, {:.2f} at {}".format(
+                init, curve.losses[0], curve.losses[-1], curve.iters[-1]))
+
+    path = os.path.join(FLAGS.outDir, 'warmstart_curves.csv')
+    with open(path, 'w') as f:
+        f.write('iteration,random,masked,cached\n')
+        for n, i in enumerate(curves['random'].iters):
+            f.write('{},{:.4f},{:.4f},{:.4f}\n'.format(
+                i, curves['random'].losses[n], curves['masked'].losses[n],
+                curves['cached'].losses[n]))
+    print(" [*] Wrote {}".format(path))
+
+if __name__ == '__main__':
+    tf.app.run()
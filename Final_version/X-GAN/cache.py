@@ -0,0 +1,180 @@
+from __future__ import division
+import json
+import struct
+import numpy as np
+
+from loader import BatchLoader, image_loader
+
+# Pre-decoded training cache
+# All named image arrays are stored back to back in one file, after a small
+# JSON header, so that batches can be gathered from a np.memmap instead of
+# decoding the same JPEGs every epoch
+#
+# Layout: MAGIC | uint32 header length | JSON header | padding | arrays
+
+MAGIC = b'XGANPACK'
+ALIGN = 64
+VERSION = 1
+
+
+def _aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def pack_images(path, datasets, input_height, input_width,
+                resize_height=64, resize_width=64, is_crop=True,
+                is_grayscale=False, dtype='float32', chunk_size=256,
+                num_workers=4):
+    """Decode every file of `datasets` (a list of (name, files) pairs) once
+    and write the transformed images to `path`.
+
+    float32 stores the exact `get_image` output and is read back without a
+    copy, uint8 is 4x smaller and is normalized when a batch is read.
+    """
+    assert(dtype in ('float32', 'uint8'))
+    c_dim = 1 if is_grayscale else 3
+    image_dims = [resize_height, resize_width, c_dim]
+    item_size = int(np.prod(image_dims)) * np.dtype(dtype).itemsize
+
+    header = {
+        'version': VERSION,
+        'dtype': dtype,
+        'input_height': input_height,
+        'input_width': input_width,
+        'output_height': resize_height,
+        'output_width': resize_width,
+        'is_crop': bool(is_crop),
+        'is_grayscale': bool(is_grayscale),
+        'arrays': {},
+    }
+
+    # Offsets are relative to the first array, the header length is only
+    # known once all of them are in it
+    offset = 0
+    for name, files in datasets:
+        header['arrays'][name] = {
+            'shape': [len(files)] + image_dims,
+            'offset': offset,
+            'files': list(files),
+        }
+        offset = _aligned(offset + len(files) * item_size)
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 4 + len(header_bytes))
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header_bytes)))
+        f.write(header_bytes)
+        f.truncate(data_start + offset)
+
+    load_fn = image_loader(input_height, input_width,
+                           resize_height=resize_height,
+                           resize_width=resize_width,
+                           is_crop=is_crop,
+                           is_grayscale=is_grayscale)
+    for name, files in datasets:
+        info = header['arrays'][name]
+        if not files:
+            continue
+        out = np.memmap(path, dtype=dtype, mode='r+',
+                        offset=data_start + info['offset'],
+                        shape=tuple(info['shape']))
+        chunks = [files[i:i + chunk_size]
+                  for i in range(0, len(files), chunk_size)]
+        loader = BatchLoader(chunks, load_fn, is_grayscale=is_grayscale,
+                             num_workers=num_workers)
+        start = 0
+        for chunk in loader:
+            if dtype == 'uint8':
+                chunk = np.rint((chunk + 1.) * 127.5)
+            out[start:start + len(chunk)] = chunk
+            start += len(chunk)
+        loader.close()
+        out.flush()
+        del out
+        print(" [*] Packed {} images of '{}' into {}".format(
+            len(files), name, path))
+
+
+class PackedDataset(object):
+    """Read-only view over a file written by `pack_images`."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} is not a packed image cache'.format(path))
+            header_len = struct.unpack('<I', f.read(4))[0]
+            self.header = json.loads(f.read(header_len).decode('utf-8'))
+        if self.header['version'] != VERSION:
+            raise ValueError('Unsupported cache version {} in {}'.format(
+                self.header['version'], path))
+        self.dtype = self.header['dtype']
+        data_start = _aligned(len(MAGIC) + 4 + header_len)
+
+        # uint8 batches are gathered here before they are normalized into
+        # `out` of take, one buffer per array reused by every call
+        self.staging = {}
+        self.arrays = {}
+        for name, info in self.header['arrays'].items():
+            if info['shape'][0] == 0:
+                self.arrays[name] = np.zeros(info['shape'], dtype=self.dtype)
+                continue
+            self.arrays[name] = np.memmap(path, dtype=self.dtype, mode='r',
+                                          offset=data_start + info['offset'],
+                                          shape=tuple(info['shape']))
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def size(self, name):
+        return self.arrays[name].shape[0]
+
+    def files(self, name):
+        return self.header['arrays'][name]['files']
+
+    def take(self, name, indices, flatten=False, out=None):
+        # Copy of the images at arbitrary `indices`, e.g. one shard's or a
+        # shuffled batch, gathered into `out` if it is given. uint8 caches
+        # are normalized to the get_image range on the fly
+        images = self.arrays[name]
+        indices = np.asarray(indices)
+        if out is None:
+            batch = images[indices]
+            if self.dtype == 'uint8':
+                batch = batch.astype(np.float32) / 127.5 - 1.
+        else:
+            batch = out[:len(indices)].reshape(
+                (len(indices),) + images.shape[1:])
+            if self.dtype == 'uint8':
+                staging = self.staging.get(name)
+                if staging is None or staging.shape != batch.shape:
+                    staging = np.empty(batch.shape, dtype=np.uint8)
+                    self.staging[name] = staging
+                np.take(images, indices, axis=0, out=staging)
+                np.multiply(staging, np.float32(1. / 127.5), out=batch)
+                batch -= 1.
+            else:
+                np.take(images, indices, axis=0, out=batch)
+        if flatten:
+            batch = batch.reshape([len(batch), -1])
+        return batch
+
+    def check(self, input_height, input_width, resize_height, resize_width,
+              is_crop, is_grayscale):
+        expected = {
+            'input_height': input_height,
+            'input_width': input_width,
+            'output_height': resize_height,
+            'output_width': resize_width,
+            'is_crop': bool(is_crop),
+            'is_grayscale': bool(is_grayscale),
+        }
+        for key, value in expected.items():
+            if self.header[key] != value:
+                raise ValueError(
+                    '{} was packed with {}={}, but the model expects {}'.format(
+                        self.path, key, self.header[key], value))
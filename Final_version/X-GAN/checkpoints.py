@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+from glob import glob
+
+from writer import SnapshotWriter
+
+# Background checkpoints for DCGAN.train
+# A save only fetches the variable values into host memory, the training
+# loop continues while a worker thread loads them into a copy of the
+# variables in a separate CPU graph and writes an ordinary TensorFlow
+# checkpoint from there. It is restored with the model's own saver.
+#
+# Every checkpoint is also listed in checkpoint_dir/manifest.json with its
+# step, hyperparameters, variable shapes, the sizes of its files and a hash
+# of its .index file, so a compatible one can be found without building the
+# model or knowing the model_dir it was saved under. The index holds a
+# checksum of every tensor, a hash of all the data is only computed and
+# checked with `verify`, restoring reads the data again anyway.
+#
+# Only CheckpointWriter needs TensorFlow and imports it, the manifest and
+# the retention policy can be read without it.
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def checkpoint_files(prefix):
+    # File name -> size
+    return dict((os.path.basename(path), os.path.getsize(path))
+                for path in glob(prefix + '.*'))
+
+
+def checkpoint_hash(prefix, full=False):
+    # Of the .index file, of every file with `full`
+    digest = hashlib.sha1()
+    paths = sorted(glob(prefix + '.*')) if full else [prefix + '.index']
+    for path in paths:
+        digest.update(os.path.basename(path).encode('utf-8'))
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest(object):
+    """The checkpoints saved under `checkpoint_dir`, newest last. With
+    `verify` a hash of all their data is recorded and checked as well."""
+
+    def __init__(self, checkpoint_dir, verify=False):
+        self.checkpoint_dir = checkpoint_dir
+        self.verify = verify
+        self.path = os.path.join(checkpoint_dir, MANIFEST_NAME)
+
+    def prefix(self, entry):
+        return os.path.join(self.checkpoint_dir, entry['path'])
+
+    def entries(self):
+        # Only checkpoints whose files still exist
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            entries = json.load(f)
+        return [e for e in entries
+                if os.path.exists(self.prefix(e) + '.index')]
+
+    def add(self, prefix, step, architecture, hparams, shapes):
+        entry = {
+            'path': os.path.relpath(prefix, self.checkpoint_dir),
+            'step': int(step),
+            'time': time.time(),
+            'architecture': architecture,
+            'hparams': hparams,
+            'shapes': shapes,
+            'files': checkpoint_files(prefix),
+            'index_hash': checkpoint_hash(prefix),
+        }
+        if self.verify:
+            entry['hash'] = checkpoint_hash(prefix, full=True)
+        entries = [e for e in self.entries() if e['path'] != entry['path']]
+        entries.append(entry)
+        fd, tmp = tempfile.mkstemp(dir=self.checkpoint_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+        return entry
+
+    def candidates(self, architecture, dataset=None, same_dataset=False):
+        """Entries with the same `architecture`, best first: saved from
+        `dataset`, then the most recent. `same_dataset` drops the others."""
+        matching = [e for e in self.entries()
+                    if e['architecture'] == architecture and not (
+                        same_dataset and
+                        e['hparams'].get('dataset') != dataset)]
+        matching.sort(key=lambda e: (
+            e['hparams'].get('dataset') == dataset, e['time']), reverse=True)
+        return matching
+
+    def find(self, architecture, dataset=None):
+        candidates = self.candidates(architecture, dataset)
+        return candidates[0] if candidates else None
+
+    def require(self, architecture, dataset=None):
+        """`find` that raises if the manifest lists checkpoints but none
+        fits `architecture`, cheap enough to call before building a graph.
+        Without a manifest there is nothing to check."""
+        entries = self.entries()
+        entry = self.find(architecture, dataset)
+        if entries and entry is None:
+            raise ValueError(
+                'No checkpoint in {} fits {}, the newest was saved for '
+                '{}'.format(self.checkpoint_dir, architecture,
+                            entries[-1]['architecture']))
+        return entry
+
+    def check(self, entry, shapes):
+        """Why `entry` cannot be restored into variables of `shapes`
+        (name -> shape), None if it can"""
+        for name, shape in entry['shapes'].items():
+            if name not in shapes:
+                return 'the model has no {}'.format(name)
+            if list(shapes[name]) != list(shape):
+                return '{} is {} in the checkpoint, {} in the model'.format(
+                    name, shape, shapes[name])
+        missing = [name for name in shapes if name not in entry['shapes']]
+        if missing:
+            return 'the checkpoint has no {}'.format(', '.join(missing[:3]))
+        prefix = self.prefix(entry)
+        if checkpoint_files(prefix) != entry.get('files') or \
+                checkpoint_hash(prefix) != entry.get('index_hash'):
+            return 'its files changed since it was saved'
+        if self.verify and 'hash' in entry and \
+                checkpoint_hash(prefix, full=True) != entry['hash']:
+            return 'its data changed since it was saved'
+        return None
+
+
+class Retention(object):
+    """Which checkpoints to keep: the `keep_last` most recent, one every
+    `keep_hours` hours and the `keep_best` ones with the lowest metric.
+    0 disables a rule, with all three disabled every checkpoint is kept."""
+
+    def __init__(self, keep_last=5, keep_hours=0., keep_best=0):
+        self.keep_last = keep_last
+        self.keep_hours = keep_hours
+        self.keep_best = keep_best
+        self.records = []
+        self._last_hourly = None
+
+    def add(self, path, step, metric=None, now=None):
+        """Records a new checkpoint, returns the paths to delete"""
+        now = time.time() if now is None else now
+        hourly = self.keep_hours > 0 and (
+            self._last_hourly is None or
+            now - self._last_hourly >= self.keep_hours * 3600)
+        if hourly:
+            self._last_hourly = now
+        self.records.append({'path': path, 'step': step, 'time': now,
+                             'metric': metric, 'hourly': hourly})
+
+        if not (self.keep_last > 0 or self.keep_hours > 0 or
+                self.keep_best > 0):
+            return []
+        keep = set(r['path'] for r in self.records if r['hourly'])
+        if self.keep_last > 0:
+            keep.update(r['path'] for r in self.records[-self.keep_last:])
+        if self.keep_best > 0:
+            scored = [r for r in self.records if r['metric'] is not None]
+            scored.sort(key=lambda r: r['metric'])
+            keep.update(r['path'] for r in scored[:self.keep_best])
+
+        dropped = [r['path'] for r in self.records if r['path'] not in keep]
+        self.records = [r for r in self.records if r['path'] in keep]
+        return dropped
+
+    def paths(self):
+        return [r['path'] for r in sorted(self.records,
+                                          key=lambda r: r['step'])]
+
+
+class CheckpointWriter(object):
+    """Saves `var_list` of `sess` to `prefix-<step>` in the background.
+
+    With `background=False` the checkpoint is written before `save`
+    returns. `save` waits if the previous checkpoint is still being
+    written, so at most one snapshot is held in memory besides the one
+    being written. With a `manifest` every checkpoint is recorded in it
+    with `architecture`, `hparams` and the shapes of `var_list`.
+
+    A write that fails in the background is raised again by the next
+    `save`, `flush` or `close`. `saves` only counts written checkpoints.
+    """
+
+    def __init__(self, sess, var_list, retention=None, background=True,
+                 log=None, manifest=None, architecture=None, hparams=None):
+        self.sess = sess
+        self.var_list = list(var_list)
+        self.names = [v.op.name for v in self.var_list]
+        self.shapes = dict((v.op.name, v.get_shape().as_list())
+                           for v in self.var_list)
+        self.manifest = manifest
+        self.architecture = architecture
+        self.hparams = hparams or {}
+        self.retention = retention or Retention()
+        self.log = log
+        self.stall_time = 0.0
+        self.write_time = 0.0
+        self.saves = 0
+        self._mirror = None
+        self._error = None
+        self._writer = SnapshotWriter(1 if background else 0, 'block')
+
+    def _raise(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def save(self, prefix, step, metric=None):
+        self._raise()
+        start = time.time()
+        values = self.sess.run(self.var_list)
+        snapshot_time = time.time() - start
+        self._writer.submit(self._write, prefix, step, metric, values,
+                            snapshot_time)
+        stall = time.time() - start
+        self.stall_time += stall
+        # Written synchronously, a failure is raised right away
+        self._raise()
+        return stall
+
+    def _build_mirror(self, values):
+        import tensorflow as tf
+        graph = tf.Graph()
+        with graph.as_default():
+            feeds, inits, saved = [], [], {}
+            for name, value in zip(self.names, values):
+                ph = tf.placeholder(value.dtype, shape=value.shape)
+                var = tf.Variable(ph, trainable=False, collections=[])
+                feeds.append(ph)
+                inits.append(var.initializer)
+                saved[name] = var
+            saver = tf.train.Saver(saved, max_to_keep=None,
+                                   write_version=tf.train.SaverDef.V2)
+        sess = tf.Session(graph=graph, config=tf.ConfigProto(
+            device_count={'GPU': 0}))
+        self._mirror = (sess, feeds, inits, saver)
+
+    def _write(self, prefix, step, metric, values, snapshot_time):
+        # SnapshotWriter only prints what a job raises, keep it for the
+        # training thread instead
+        try:
+            self._save(prefix, step, metric, values, snapshot_time)
+        except Exception as e:
+            print(" [!] Checkpoint {}-{} failed: {}".format(
+                os.path.basename(prefix), step, e))
+            self._error = e
+
+    def _save(self, prefix, step, metric, values, snapshot_time):
+        import tensorflow as tf
+        start = time.time()
+        if self._mirror is None:
+            self._build_mirror(values)
+        sess, feeds, inits, saver = self._mirror
+        sess.run(inits, feed_dict=dict(zip(feeds, values)))
+        path = saver.save(sess, prefix, global_step=step,
+                          write_meta_graph=False,
+                          write_state=False)
+
+        for dropped in self.retention.add(path, step, metric):
+            for f in glob(dropped + '.*'):
+                os.remove(f)
+        tf.train.update_checkpoint_state(
+            os.path.dirname(path), path,
+            all_model_checkpoint_paths=self.retention.paths())
+        if self.manifest is not None:
+            self.manifest.add(path, step, self.architecture, self.hparams,
+                              self.shapes)
+
+        duration = time.time() - start
+        self.write_time += duration
+        self.saves += 1
+        print(" [*] Saved {}: snapshot {:.3f}s, write {:.3f}s".format(
+            os.path.basename(path), snapshot_time, duration))
+        if self.log is not None:
+            self.log(step, snapshot_time, duration)
+
+    def flush(self):
+        self._writer.flush()
+        self._raise()
+
+    def close(self):
+        self._writer.close()
+        if self._mirror is not None:
+            self._mirror[0].close()
+            self._mirror = None
+        self._raise()
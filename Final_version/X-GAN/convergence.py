@@ -0,0 +1,74 @@
+import numpy as np
+
+# Per image convergence of inpainting
+# The restarts of an image take consecutive slots of a batch, the loss of
+# an image is the lowest of its slots. Used by DCGAN.inpaint, server.py
+# and bench_warmstart.py, needs only numpy.
+
+
+class PlateauTracker(object):
+    """Per image convergence tracking and early stopping: an image is done
+    once the best loss over its restarts has not dropped by a relative `tol`
+    for `patience` iterations. A `patience` of 0 never stops, it only keeps
+    the lowest loss of every image every `every` iterations for `report`."""
+
+    def __init__(self, nImgs, restarts, patience, tol, every=50):
+        self.restarts = restarts
+        self.patience = patience
+        self.tol = tol
+        self.every = every
+        self.best = np.full(nImgs, np.inf)
+        self.lowest = np.full(nImgs, np.inf)
+        self.last = np.zeros(nImgs, dtype=np.int64)
+        self.stopped = np.full(nImgs, -1, dtype=np.int64)
+        self.done = np.zeros(nImgs, dtype=bool)
+        self.iters = []
+        self.history = []
+        self.i = None
+
+    def update(self, i, slot_loss):
+        img_loss = slot_loss[:len(self.best) * self.restarts].reshape(
+            [len(self.best), self.restarts]).min(axis=1)
+        self.lowest = np.minimum(self.lowest, img_loss)
+        self.i = i
+        if not self.iters or i - self.iters[-1] >= self.every:
+            self.iters.append(i)
+            self.history.append(self.lowest.copy())
+        if self.patience <= 0:
+            return False
+
+        better = img_loss < self.best * (1.0 - self.tol)
+        self.best[better] = img_loss[better]
+        self.last[better] = i
+        self.done = (i - self.last) >= self.patience
+        self.stopped[self.done & (self.stopped < 0)] = i
+        if self.done.all():
+            print(' [*] All images plateaued at iteration {}'.format(i))
+            return True
+        return False
+
+    def frozen_slots(self):
+        return np.repeat(self.done, self.restarts)
+
+    def report(self, files):
+        """One record per image: lowest loss, the iteration it stopped at
+        (None if it ran to the end) and its loss curve. Without any update
+        (nIter 0) the loss is None and the curve empty."""
+        iters, history = list(self.iters), list(self.history)
+        if iters and iters[-1] != self.i:
+            iters.append(self.i)
+            history.append(self.lowest)
+        history = np.array(history).reshape([len(iters), len(self.lowest)])
+        records = []
+        for n, f in enumerate(files):
+            stopped = int(self.stopped[n]) if self.stopped[n] >= 0 else None
+            records.append({
+                'file': f,
+                'loss': float(self.lowest[n]) if iters else None,
+                'converged': stopped is not None,
+                'stopped_at': stopped,
+                'last_improved': int(self.last[n]) if self.patience > 0 else None,
+                'curve': [[int(i), float(l)]
+                          for i, l in zip(iters, history[:, n])],
+            })
+        return records
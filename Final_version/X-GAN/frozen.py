@@ -0,0 +1,34 @@
+import tensorflow as tf
+
+# Standalone sampler
+# Loads a graph written by DCGAN.export_sampler: constants only, batch norm
+# folded into the layer weights, so neither the model code nor a checkpoint
+# is needed to generate images.
+#
+#     sampler = FrozenSampler('sampler.pb')
+#     images = sampler.sample(z)  # z: [n, z_dim] in [-1, 1], images in [-1, 1]
+
+Z_NAME = 'z'
+OUTPUT_NAME = 'sampler'
+
+
+class FrozenSampler(object):
+
+    def __init__(self, path, config=None):
+        graph_def = tf.GraphDef()
+        with open(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.z = self.graph.get_tensor_by_name(Z_NAME + ':0')
+        self.output = self.graph.get_tensor_by_name(OUTPUT_NAME + ':0')
+        self.z_dim = int(self.z.get_shape()[1])
+        self.sess = tf.Session(graph=self.graph, config=config)
+
+    def sample(self, z):
+        return self.sess.run(self.output, feed_dict={self.z: z})
+
+    def close(self):
+        self.sess.close()
@@ -1,7 +1,15 @@
+import time
+START_TIME = time.time()
+
 import os
 import sys
+import subprocess
+import multiprocessing
 import tensorflow as tf
-from model import DCGAN
+from glob import glob
+
+# The model code is imported in main, after the flags are parsed, so the
+# --workers driver does not load it at all
 
 # Define a tensorflow app and the flags
 flags = tf.app.flags
@@ -21,6 +29,21 @@ flags.DEFINE_float(flag_name="lr", default_value=0.01,
 flags.DEFINE_float(flag_name="momentum", default_value=0.8,
                    docstring="Momentum term of AdamOptimizer [0.8]")
 
+flags.DEFINE_integer(flag_name="restarts", default_value=1,
+                     docstring="Random restarts per image, optimized together in one batch [1]")
+
+flags.DEFINE_integer(flag_name="plateau_iters", default_value=0,
+                     docstring="Stop an image after this many iterations without improvement, 0 to disable [0]")
+
+flags.DEFINE_float(flag_name="plateau_tol", default_value=1e-3,
+                   docstring="Relative contextual loss decrease that counts as an improvement [1e-3]")
+
+flags.DEFINE_boolean(flag_name="in_graph", default_value=False,
+                     docstring="True to run the z updates inside the graph, 50 iterations per session call [False]")
+
+flags.DEFINE_string(flag_name="precision", default_value="float32",
+                    docstring="Precision of the generator and discriminator while inpainting: {'float32', 'float16', 'bfloat16'}, losses stay float32 [float32]")
+
 flags.DEFINE_float(flag_name="gpu_utilization", default_value=0.8,
                    docstring="Per process GPU memory fraction [0.8]")
 
@@ -34,7 +57,10 @@ flags.DEFINE_string(flag_name="outDir", default_value="inpainted",
                     docstring="Directory name to output inpainting results [inpaintings]")
 
 flags.DEFINE_string(flag_name="maskType", default_value="random",
-                    docstring="The type of masks, four choices:{'random', 'center', 'left', 'full'} [center] ")
+                    docstring="Mask spec: {'random', 'blocks', 'center', 'left', 'right', 'strokes', 'full', 'png:path'}, optionally with ':param', comma separated specs are cycled over the images [random] ")
+
+flags.DEFINE_integer(flag_name="mask_seed", default_value=-1,
+                     docstring="Seed of the random masks, -1 for unseeded [-1]")
 
 flags.DEFINE_string(flag_name="imgs", default_value="testing_data",
                     docstring="Directory name to testing data that will be painted [testing_data]")
@@ -59,10 +85,103 @@ flags.DEFINE_string(flag_name="input_file_extension", default_value="*.jpg",
 flags.DEFINE_boolean(flag_name="is_crop", default_value=False,
                      docstring="True for training, False for testing [False]")
 
+flags.DEFINE_boolean(flag_name="pack", default_value=False,
+                     docstring="True to decode the testing data once into the cache file before inpainting [False]")
+
+flags.DEFINE_string(flag_name="cache_file", default_value="",
+                    docstring="Packed image cache to inpaint instead of decoding JPEGs, see --pack []")
+
+flags.DEFINE_string(flag_name="cache_dtype", default_value="float32",
+                    docstring="Storage type of packed images, float32 needs no conversion, uint8 is 4x smaller [float32]")
+
+flags.DEFINE_integer(flag_name="snapshot_queue", default_value=8,
+                     docstring="Snapshots waiting for the background writer, 0 to write synchronously [8]")
+
+flags.DEFINE_string(flag_name="snapshot_policy", default_value="block",
+                    docstring="What to do when the writer queue is full: {'block', 'drop'} [block]")
+
+flags.DEFINE_string(flag_name="init", default_value="random",
+                    docstring="Starting z of the first restart: {'random', 'masked'}, masked starts from the masked image [random]")
+
+flags.DEFINE_string(flag_name="latent_cache", default_value="",
+                    docstring="Directory of the best z per image, reused as starting z when an image is inpainted again []")
+
+flags.DEFINE_boolean(flag_name="grids", default_value=True,
+                     docstring="True to also write the progress and before/masked/completed grids of every batch [True]")
+
+flags.DEFINE_integer(flag_name="workers", default_value=1,
+                     docstring="Worker processes, each inpainting its own shard of the images with its own session [1]")
+
+flags.DEFINE_integer(flag_name="num_shards", default_value=1,
+                     docstring="Number of shards the images are split into, set by --workers [1]")
+
+flags.DEFINE_integer(flag_name="shard_index", default_value=0,
+                     docstring="Shard inpainted by this process, set by --workers [0]")
+
+flags.DEFINE_integer(flag_name="threads", default_value=0,
+                     docstring="Intra-op threads per process, 0 for the TensorFlow default, or cores / workers with --workers [0]")
+
+flags.DEFINE_string(flag_name="weights", default_value="",
+                    docstring="Restore from this weight file (main.py --export_weights) instead of the checkpoint []")
+
+flags.DEFINE_boolean(flag_name="verify_checkpoints", default_value=False,
+                     docstring="True to check the checkpoint data against the hash recorded by main.py --verify_checkpoints before restoring [False]")
+
+flags.DEFINE_string(flag_name="graph_cache", default_value="",
+                    docstring="Directory to save the built inference graph to and import it from on later runs []")
+
+flags.DEFINE_boolean(flag_name="startup_only", default_value=False,
+                     docstring="True to exit once the checkpoint is restored, for timing the startup [False]")
+
 
 FLAGS = flags.FLAGS
 
 
+def run_shards():
+    """Start one inpainter.py per shard and merge the shard logs.
+
+    Every worker restores its own copy of the checkpoint and writes its
+    grids and log to outDir/shard_<i>; completed images of all shards go
+    to outDir/completed, which is also what lets a rerun skip them.
+    """
+    if FLAGS.pack:
+        from cache import pack_images
+        if not FLAGS.cache_file:
+            FLAGS.cache_file = FLAGS.imgs.rstrip('/') + '.pack'
+        pack_images(FLAGS.cache_file,
+                    [('imgs', glob(os.path.join(FLAGS.imgs, '*.jpg')))],
+                    FLAGS.input_height, FLAGS.input_width,
+                    is_crop=FLAGS.is_crop, dtype=FLAGS.cache_dtype)
+
+    threads = FLAGS.threads or max(
+        1, multiprocessing.cpu_count() // FLAGS.workers)
+    workers = []
+    for i in range(FLAGS.workers):
+        # Later flags override the ones given to the driver
+        args = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + [
+            '--workers=1',
+            '--num_shards={}'.format(FLAGS.workers),
+            '--shard_index={}'.format(i),
+            '--threads={}'.format(threads),
+            '--pack=False',
+            '--cache_file={}'.format(FLAGS.cache_file),
+        ]
+        workers.append(subprocess.Popen(args))
+    failed = [i for i, worker in enumerate(workers) if worker.wait() != 0]
+
+    for log in ['Inpaint_Results.txt', 'results.jsonl', 'convergence.jsonl']:
+        with open(os.path.join(FLAGS.outDir, log), 'w') as f:
+            for i in range(FLAGS.workers):
+                path = os.path.join(FLAGS.outDir, 'shard_{}'.format(i), log)
+                if os.path.exists(path):
+                    with open(path) as shard_log:
+                        f.write(shard_log.read())
+    if failed:
+        raise Exception("[!!!] Shards {} failed, rerun to resume them".format(
+            failed))
+    print(" [*] Merged the logs of {} shards".format(FLAGS.workers))
+
+
 def main(_):
     assert(os.path.exists(FLAGS.checkpointDir))
 
@@ -70,14 +189,43 @@ def main(_):
     if not FLAGS.input_width:
         FLAGS.input_width = FLAGS.input_height
 
+    if FLAGS.workers > 1:
+        return run_shards()
+
     def get_default_gpu_session(fraction=0.8):
         if fraction > 1:
             fraction = 0.8
         config = tf.ConfigProto(allow_soft_placement=True)
+        if FLAGS.threads > 0:
+            config.intra_op_parallelism_threads = FLAGS.threads
         config.gpu_options.allow_growth = True
         config.gpu_options.per_process_gpu_memory_fraction = fraction
         return tf.Session(config=config)
 
+    from model import DCGAN, graph_cache_path, model_architecture
+    from checkpoints import Manifest
+    import_time = time.time()
+
+    # The layer sizes of the DCGAN built below (default output size)
+    architecture = model_architecture(c_dim=FLAGS.c_dim)
+
+    # Fail before building the graph if no saved checkpoint fits it
+    if not FLAGS.weights:
+        Manifest(FLAGS.checkpointDir).require(architecture, FLAGS.dataset)
+
+    # A graph saved by an earlier run with the same options is imported
+    # instead of built
+    graph_file = None
+    if FLAGS.graph_cache:
+        graph_file = graph_cache_path(
+            FLAGS.graph_cache,
+            input_height=FLAGS.input_height, input_width=FLAGS.input_width,
+            is_crop=FLAGS.is_crop, architecture=architecture,
+            lambda_val=FLAGS.lambda_val,
+            precision=FLAGS.precision, in_graph=FLAGS.in_graph,
+            lr=FLAGS.lr, momentum=FLAGS.momentum)
+    cached = graph_file is not None and os.path.exists(graph_file)
+
     with get_default_gpu_session(FLAGS.gpu_utilization) as sess:
 
         dcgan_instance = DCGAN(
@@ -91,8 +239,39 @@ def main(_):
             checkpoint_dir=FLAGS.checkpointDir,
             lambda_val=FLAGS.lambda_val,
             # Xx-GAN
-            dataset_name2=FLAGS.dataset2
+            dataset_name2=FLAGS.dataset2,
+            summaries=False,
+            graph_file=graph_file if cached else None
         )
+        if not cached:
+            if FLAGS.precision != 'float32':
+                dcgan_instance.build_inference(FLAGS.precision)
+            if FLAGS.in_graph:
+                dcgan_instance.build_inpaint_loop(FLAGS.lr, FLAGS.momentum)
+            if graph_file is not None:
+                os.makedirs(FLAGS.graph_cache, exist_ok=True)
+                dcgan_instance.save_graph(graph_file)
+        graph_time = time.time()
+        print(" [*] Startup: imports {:.2f}s, graph {:.2f}s ({})".format(
+            import_time - START_TIME, graph_time - import_time,
+            'cached' if cached else 'built'))
+
+        if FLAGS.startup_only:
+            tf.global_variables_initializer().run()
+            assert(dcgan_instance.restore(
+                FLAGS.checkpointDir, FLAGS.weights,
+                verify=FLAGS.verify_checkpoints)[0])
+            print(" [*] Startup: restore {:.2f}s, ready after {:.2f}s".format(
+                time.time() - graph_time, time.time() - START_TIME))
+            return
+
+        if FLAGS.pack:
+            if not FLAGS.cache_file:
+                FLAGS.cache_file = FLAGS.imgs.rstrip('/') + '.pack'
+            dcgan_instance.pack(FLAGS.cache_file, [
+                ('imgs', glob(os.path.join(FLAGS.imgs, '*.jpg'))),
+            ], dtype=FLAGS.cache_dtype)
+
         dcgan_instance.inpaint(FLAGS)
 
 if __name__ == '__main__':
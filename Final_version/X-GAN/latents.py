@@ -0,0 +1,75 @@
+from __future__ import division
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+# Warm starts for inpainting
+# In X-GAN the generator input is itself an image, so the masked test image
+# (with noise in its holes) is a much closer first z than uniform noise.
+# The best z found for an image can also be kept in a cache keyed by the
+# image content and reused by later runs.
+
+INITS = ('random', 'masked')
+
+
+def image_key(image):
+    return hashlib.sha1(
+        np.ascontiguousarray(image, dtype=np.float32).tobytes()).hexdigest()
+
+
+class LatentCache(object):
+    """Best z per image, one .npy file per image hash under `path`"""
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, image):
+        return os.path.join(self.path, image_key(image) + '.npy')
+
+    def get(self, image):
+        path = self._file(image)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.load(path)
+
+    def put(self, image, z):
+        # Written to a temporary file first, shards may share the cache
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.asarray(z, dtype=np.float32))
+        os.replace(tmp, self._file(image))
+
+
+def initial_zhats(init, images, masks, z_dim, restarts=1, cache=None):
+    """First z of every slot for `images` and `masks` (one per image).
+
+    'random' starts every slot from uniform noise. 'masked' starts the
+    first restart of every image from the image itself, with noise in its
+    holes, the other restarts stay random. Images found in `cache` start
+    from their cached z instead.
+    """
+    if init not in INITS:
+        raise ValueError('Unknown init: {}'.format(init))
+    n = len(images)
+    zhats = np.random.uniform(-1, 1, size=(n * restarts, z_dim))
+
+    if init == 'masked':
+        if images[0].size != z_dim:
+            raise ValueError('masked init needs images of z_dim={} values, '
+                             'got {}'.format(z_dim, images[0].size))
+        noise = zhats[::restarts].reshape(images.shape)
+        zhats[::restarts] = (masks * images + (1.0 - masks) * noise) \
+            .reshape([n, z_dim])
+
+    if cache is not None:
+        for i, image in enumerate(images):
+            z = cache.get(image)
+            if z is not None:
+                zhats[i * restarts] = z
+    return zhats
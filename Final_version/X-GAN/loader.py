@@ -0,0 +1,231 @@
+from __future__ import division
+import os
+import time
+import threading
+import numpy as np
+from functools import partial
+from six.moves import queue, xrange
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Background input pipeline for DCGAN.train
+# Decodes, crops and normalizes upcoming batches on a thread (or process)
+# pool and keeps a bounded queue of them ahead of sess.run
+
+
+def load_batch(batch_files, load_fn, is_grayscale=False, flatten=False,
+               out=None):
+    if out is not None:
+        # Decode straight into a preallocated float32 buffer
+        out = out[:len(batch_files)]
+        for i, batch_file in enumerate(batch_files):
+            out[i] = load_fn(batch_file).reshape(out.shape[1:])
+        return out
+    batch = np.array([load_fn(batch_file)
+                      for batch_file in batch_files]).astype(np.float32)
+    if is_grayscale:
+        batch = batch[:, :, :, None]
+    if flatten:
+        batch = batch.reshape([len(batch_files), -1])
+    return batch
+
+
+def image_loader(input_height, input_width, resize_height=64, resize_width=64,
+                 is_crop=True, is_grayscale=False):
+    # Module level partial so it can be pickled for a process pool. utils
+    # imports TensorFlow, the sampler and buffers here do not need it
+    from utils import get_image
+    return partial(get_image,
+                   input_height=input_height,
+                   input_width=input_width,
+                   resize_height=resize_height,
+                   resize_width=resize_width,
+                   is_crop=is_crop,
+                   is_grayscale=is_grayscale)
+
+
+class EpochSampler(object):
+    """Batches of indices into `files` and `files2`, shuffled with a new
+    permutation every epoch drawn from one seeded generator.
+
+    With `pair_by_name` only names found in both lists are used and batch
+    k of both streams holds the same file names, otherwise each stream is
+    shuffled on its own and the shorter one wraps around. Without
+    `use_files2` (and without pairing) `files2` is never indexed, it may be
+    empty and the batches of the second stream are an empty list.
+    """
+
+    def __init__(self, files, files2, batch_size, seed=None, shuffle=True,
+                 pair_by_name=False, use_files2=True):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.paired = pair_by_name
+        self.use_files2 = use_files2 or pair_by_name
+        self.rng = np.random.RandomState(seed)
+        if pair_by_name:
+            index2 = dict((os.path.basename(f), i)
+                          for i, f in enumerate(files2))
+            pairs = [(i, index2[os.path.basename(f)])
+                     for i, f in enumerate(files)
+                     if os.path.basename(f) in index2]
+            if not pairs:
+                raise ValueError('No file names common to both datasets')
+            self.indices = np.array([i for i, _ in pairs])
+            self.indices2 = np.array([j for _, j in pairs])
+        else:
+            self.indices = np.arange(len(files))
+            self.indices2 = np.arange(len(files2))
+
+    def __len__(self):
+        return len(self.indices)
+
+    def _order(self, n):
+        return self.rng.permutation(n) if self.shuffle else np.arange(n)
+
+    def epoch(self, limit=None):
+        """(batches, batches2), index arrays of one epoch of full batches"""
+        n = len(self.indices) if limit is None else \
+            min(len(self.indices), limit)
+        n = n // self.batch_size * self.batch_size
+        order = self._order(len(self.indices))[:n]
+        first = self.indices[order]
+        batches = [first[i:i + self.batch_size]
+                   for i in xrange(0, n, self.batch_size)]
+        if not self.use_files2:
+            return batches, []
+        if self.paired:
+            order2 = order
+        else:
+            if not len(self.indices2):
+                raise ValueError('The second dataset is empty')
+            order2 = np.resize(self._order(len(self.indices2)), n)
+        second = self.indices2[order2]
+        return batches, [second[i:i + self.batch_size]
+                         for i in xrange(0, n, self.batch_size)]
+
+
+class BatchBuffers(object):
+    """Preallocated float32 batch arrays, filled in place step after step"""
+
+    def __init__(self):
+        self.buffers = {}
+        if hasattr(np.random, 'default_rng'):
+            self.rng = np.random.default_rng()
+        else:
+            self.rng = None
+
+    def get(self, name, shape):
+        shape = tuple(shape)
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != shape:
+            buf = np.empty(shape, dtype=np.float32)
+            self.buffers[name] = buf
+        return buf
+
+    def ring(self, name, size, shape):
+        return [self.get('{}/{}'.format(name, i), shape) for i in xrange(size)]
+
+    def uniform(self, name, shape, low=-1., high=1.):
+        buf = self.get(name, shape)
+        if self.rng is not None:
+            self.rng.random(out=buf, dtype=np.float32)
+        else:
+            # NumPy before 1.17 can only sample into a new array
+            buf[...] = np.random.random_sample(buf.shape)
+        buf *= high - low
+        buf += low
+        return buf
+
+
+class BatchLoader(object):
+    """Iterates over `batches` (a list of file lists) in order, yielding
+    float32 arrays that were decoded ahead of time by a worker pool.
+
+    With a `ring` of preallocated buffers (see BatchBuffers.ring) batches
+    are decoded into them in turn instead of into new arrays. A yielded
+    batch stays valid until the next one is requested, so the ring needs
+    `prefetch + 2` buffers.
+
+    `stall_time` accumulates the seconds the consumer spent waiting for a
+    batch that was not ready yet, i.e. the time training was input-bound.
+    """
+
+    def __init__(self, batches, load_fn, is_grayscale=False, flatten=False,
+                 num_workers=4, prefetch=8, use_processes=False, ring=None):
+        self.batches = batches
+        self.num_batches = len(batches)
+        self.stall_time = 0.0
+        self.consumed = 0
+        self.ring = ring
+        self.use_processes = use_processes
+        assert(ring is None or len(ring) >= max(1, prefetch) + 2)
+
+        self._load = partial(load_batch, load_fn=load_fn,
+                             is_grayscale=is_grayscale, flatten=flatten)
+        if use_processes:
+            self._pool = ProcessPoolExecutor(max_workers=num_workers)
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=num_workers)
+
+        # Futures are queued in submission order, so the queue size bounds
+        # how many batches can be decoded (and held in memory) ahead
+        self._queue = queue.Queue(maxsize=max(1, prefetch))
+        self._stop = threading.Event()
+        self._feeder = threading.Thread(target=self._feed)
+        self._feeder.daemon = True
+        self._feeder.start()
+
+    def _feed(self):
+        for idx, batch_files in enumerate(self.batches):
+            if self.ring is not None and not self.use_processes:
+                future = self._pool.submit(
+                    self._load, batch_files,
+                    out=self.ring[idx % len(self.ring)])
+            else:
+                future = self._pool.submit(self._load, batch_files)
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(future, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if self._stop.is_set():
+                future.cancel()
+                return
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.consumed >= self.num_batches:
+            raise StopIteration
+        start_time = time.time()
+        batch = self._queue.get().result()
+        self.stall_time += time.time() - start_time
+        if self.ring is not None and self.use_processes:
+            # Worker processes cannot write into our buffers
+            out = self.ring[self.consumed % len(self.ring)][:len(batch)]
+            np.copyto(out, batch.reshape(out.shape))
+            batch = out
+        self.consumed += 1
+        return batch
+
+    next = __next__
+
+    def stats(self):
+        return {'batches': self.consumed,
+                'stall_time': self.stall_time,
+                'avg_stall': self.stall_time / max(1, self.consumed),
+                'queued': self._queue.qsize()}
+
+    def close(self):
+        self._stop.set()
+        while True:
+            try:
+                self._queue.get_nowait().cancel()
+            except queue.Empty:
+                break
+        self._feeder.join()
+        self._pool.shutdown(wait=True)
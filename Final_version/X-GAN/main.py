@@ -1,15 +1,12 @@
 # App module
 import os
 import numpy as np
-import scipy.misc
 import tensorflow as tf
 import pprint
+from glob import glob
 
-
-# import DCGAN class
-from model import DCGAN
-# import utils
-from utils import show_all_variables
+# The model is imported by main() once the flags are parsed, so --help and
+# flag errors do not wait for it
 
 
 # Define a tensorflow app and the flags
@@ -61,6 +58,71 @@ flags.DEFINE_boolean(flag_name="is_crop", default_value=False,
 
 flags.DEFINE_float(flag_name="gpu_utilization", default_value=0.8,
                    docstring="Per process GPU memory fraction [0.8]")
+
+flags.DEFINE_integer(flag_name="loader_workers", default_value=4,
+                     docstring="Number of background workers decoding training images [4]")
+flags.DEFINE_integer(flag_name="prefetch_batches", default_value=8,
+                     docstring="Number of decoded batches kept ready ahead of training [8]")
+flags.DEFINE_boolean(flag_name="loader_processes", default_value=False,
+                     docstring="True to decode images in worker processes instead of threads [False]")
+flags.DEFINE_boolean(flag_name="trace_allocations", default_value=False,
+                     docstring="True to log the peak bytes allocated in every training step, measured with tracemalloc, which slows training down [False]")
+
+flags.DEFINE_boolean(flag_name="shuffle", default_value=True,
+                     docstring="True to visit the training images in a new random order every epoch [True]")
+flags.DEFINE_integer(flag_name="shuffle_seed", default_value=-1,
+                     docstring="Seed of the epoch order, -1 for unseeded [-1]")
+flags.DEFINE_boolean(flag_name="pair_by_name", default_value=False,
+                     docstring="True to keep dataset and dataset2 images with the same file name in the same batch slot [False]")
+flags.DEFINE_string(flag_name="z_source", default_value="noise",
+                    docstring="Generator input while training: {'noise', 'dataset2'}, dataset2 feeds its images as z [noise]")
+
+flags.DEFINE_boolean(flag_name="pack", default_value=False,
+                     docstring="True to decode dataset and dataset2 once into the cache file [False]")
+flags.DEFINE_string(flag_name="cache_file", default_value="",
+                    docstring="Packed image cache to train from instead of decoding JPEGs, see --pack []")
+flags.DEFINE_string(flag_name="cache_dtype", default_value="float32",
+                    docstring="Storage type of packed images, float32 needs no conversion, uint8 is 4x smaller [float32]")
+
+flags.DEFINE_integer(flag_name="snapshot_queue", default_value=8,
+                     docstring="Snapshots waiting for the background writer, 0 to write synchronously [8]")
+flags.DEFINE_string(flag_name="snapshot_policy", default_value="block",
+                    docstring="What to do when the writer queue is full: {'block', 'drop'} [block]")
+flags.DEFINE_boolean(flag_name="async_checkpoint", default_value=True,
+                     docstring="True to write checkpoints on a background thread from an in-memory snapshot [True]")
+flags.DEFINE_integer(flag_name="keep_checkpoints", default_value=5,
+                     docstring="Number of most recent checkpoints to keep, 0 to disable the rule [5]")
+flags.DEFINE_float(flag_name="keep_checkpoint_hours", default_value=0.,
+                   docstring="Also keep one checkpoint every this many hours, 0 to disable [0]")
+flags.DEFINE_integer(flag_name="keep_best", default_value=0,
+                     docstring="Also keep this many checkpoints with the lowest --best_metric, 0 to disable [0]")
+flags.DEFINE_string(flag_name="best_metric", default_value="g_loss",
+                    docstring="Training loss at save time used by --keep_best: {'g_loss', 'd_loss'} [g_loss]")
+flags.DEFINE_boolean(flag_name="verify_checkpoints", default_value=False,
+                     docstring="True to record a hash of all checkpoint data and check it before restoring, which reads every checkpoint twice [False]")
+flags.DEFINE_boolean(flag_name="fused_step", default_value=False,
+                     docstring="True to fetch the logged losses from the update runs, 3 session runs per step instead of 6 [False]")
+flags.DEFINE_integer(flag_name="summary_scalars", default_value=1,
+                     docstring="Write the loss summaries every this many steps, 0 to disable [1]")
+
+flags.DEFINE_integer(flag_name="summary_histograms", default_value=100,
+                     docstring="Write the z and D output histograms every this many steps, 0 to disable [100]")
+
+flags.DEFINE_integer(flag_name="summary_images", default_value=500,
+                     docstring="Write the generated image summary every this many steps, 0 to disable [500]")
+flags.DEFINE_integer(flag_name="num_towers", default_value=1,
+                     docstring="Split each batch across this many devices and average their gradients [1]")
+
+flags.DEFINE_string(flag_name="tower_device", default_value="gpu",
+                    docstring="Device type of the towers: {'gpu', 'cpu'} [gpu]")
+flags.DEFINE_string(flag_name="export_sampler", default_value="",
+                    docstring="Write the restored sampler as a frozen graph with batch norm folded in to this path, see frozen.py []")
+flags.DEFINE_string(flag_name="export_weights", default_value="",
+                    docstring="Write the restored generator and discriminator weights to this flat file for inpainter.py --weights, see weights.py []")
+flags.DEFINE_boolean(flag_name="generator_only", default_value=False,
+                     docstring="True to export and restore only the generator weights, enough for sampling but not for inpainting [False]")
+flags.DEFINE_string(flag_name="weights", default_value="",
+                    docstring="Restore test mode from this weight file instead of the checkpoint []")
 # flags.DEFINE_boolean("visualize", False, "True for visualizing, False for nothing [False]")
 FLAGS = flags.FLAGS
 
@@ -75,6 +137,11 @@ def main(_):
     if not FLAGS.output_width:
         FLAGS.output_width = FLAGS.output_height
 
+    # Every tower gets the same share of a batch
+    assert(FLAGS.batch_size % max(1, FLAGS.num_towers) == 0)
+    assert(FLAGS.z_source in ('noise', 'dataset2'))
+    assert(FLAGS.best_metric in ('g_loss', 'd_loss'))
+
     # Deal with checkpoint/sample directory path
     if not os.path.exists(FLAGS.checkpoint_dir):
         os.makedirs(FLAGS.checkpoint_dir)
@@ -86,10 +153,16 @@ def main(_):
         if fraction > 1:
             fraction = 0.8
         config = tf.ConfigProto(allow_soft_placement=True)
+        if FLAGS.tower_device == 'cpu':
+            # One CPU device per tower
+            config.device_count['CPU'] = max(1, FLAGS.num_towers)
         config.gpu_options.allow_growth = True
         config.gpu_options.per_process_gpu_memory_fraction = fraction
         return tf.Session(config=config)
 
+    # import DCGAN class
+    from model import DCGAN
+
     with get_default_gpu_session(FLAGS.gpu_utilization) as sess:
         # Deal with MNIST dataset
         if FLAGS.dataset == 'mnist':
@@ -108,7 +181,9 @@ def main(_):
                 input_fname_pattern=FLAGS.input_file_extension,
                 is_crop=FLAGS.is_crop,
                 checkpoint_dir=FLAGS.checkpoint_dir,
-                sample_dir=FLAGS.sample_dir
+                sample_dir=FLAGS.sample_dir,
+                # Test mode only restores, samples and exports
+                summaries=FLAGS.is_train
             )
         else:
             dcgan = DCGAN(
@@ -126,18 +201,42 @@ def main(_):
                 checkpoint_dir=FLAGS.checkpoint_dir,
                 sample_dir=FLAGS.sample_dir,
                 # Xx-GAN
-                dataset_name2=FLAGS.dataset2
+                dataset_name2=FLAGS.dataset2,
+                summaries=FLAGS.is_train
             )
 
-        show_all_variables()
+        if FLAGS.is_train:
+            # import utils
+            from utils import show_all_variables
+            show_all_variables()
+
+        # Deal with the packed image cache
+        if FLAGS.pack:
+            if not FLAGS.cache_file:
+                FLAGS.cache_file = os.path.join(
+                    "./data", "{}_{}.pack".format(FLAGS.dataset, FLAGS.dataset2))
+            dcgan.pack(FLAGS.cache_file, [
+                ('dataset', glob(os.path.join(
+                    "./data", FLAGS.dataset, FLAGS.input_file_extension))),
+                ('dataset2', glob(os.path.join(
+                    "./data", FLAGS.dataset2, FLAGS.input_file_extension))),
+            ], dtype=FLAGS.cache_dtype)
 
         # Deal with training
         if FLAGS.is_train:
             dcgan.train(FLAGS)
         else:
-            if not dcgan.load(FLAGS.checkpoint_dir)[0]:
+            could_load, step = dcgan.restore(
+                FLAGS.checkpoint_dir, FLAGS.weights, FLAGS.generator_only,
+                verify=FLAGS.verify_checkpoints)
+            if not could_load:
                 raise Exception(
                     "[!!!] Need to train a model first, then run test mode")
+            if FLAGS.export_weights:
+                dcgan.export_weights(FLAGS.export_weights, step,
+                                     FLAGS.generator_only)
+            if FLAGS.export_sampler:
+                dcgan.export_sampler(FLAGS.export_sampler)
 
 
 if __name__ == '__main__':
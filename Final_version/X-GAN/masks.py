@@ -0,0 +1,178 @@
+from __future__ import division
+import os
+import numpy as np
+from glob import glob
+from collections import OrderedDict
+
+# Inpainting masks
+# 1.0 marks a known pixel, 0.0 a pixel to be filled in. Every generator
+# builds the masks of a whole batch at once, one mask per image.
+#
+# A spec is "type" or "type:param", e.g. "random:0.3" or "blocks:4".
+# Comma separated specs ("center,random") are cycled over the images of a
+# batch, so one sess.run can inpaint heterogeneous holes.
+#
+#   random[:fraction]     random pixels, 0.2 of them by default
+#   blocks[:count]        random rectangles, 3 per image by default
+#   center[:scale]        centered square, 0.25 border by default
+#   left / right          left or right half
+#   strokes[:count]       free-form brush strokes, 4 per image by default
+#   full                  nothing masked
+#   png:path              PNG file, or directory of PNGs cycled over images;
+#                         white is known, black is filled in
+
+MAX_CACHED = 32
+_cache = OrderedDict()
+
+
+def random_masks(rng, n, h, w, fraction=0.2):
+    return rng.random_sample((n, h, w)) >= fraction
+
+
+def block_masks(rng, n, h, w, count=3):
+    count = int(count)
+    size_h = rng.randint(h // 8, h // 3 + 1, size=(n, count, 1, 1))
+    size_w = rng.randint(w // 8, w // 3 + 1, size=(n, count, 1, 1))
+    top = (rng.random_sample((n, count, 1, 1)) * (h - size_h)).astype(int)
+    left = (rng.random_sample((n, count, 1, 1)) * (w - size_w)).astype(int)
+    yy = np.arange(h).reshape([1, 1, h, 1])
+    xx = np.arange(w).reshape([1, 1, 1, w])
+    holes = (yy >= top) & (yy < top + size_h) & \
+        (xx >= left) & (xx < left + size_w)
+    return ~holes.any(axis=1)
+
+
+def center_masks(rng, n, h, w, scale=0.25):
+    assert(scale <= 0.5)
+    mask = np.ones((h, w), dtype=bool)
+    mask[int(h * scale):int(h * (1.0 - scale)),
+         int(w * scale):int(w * (1.0 - scale))] = False
+    return np.broadcast_to(mask, (n, h, w))
+
+
+def left_masks(rng, n, h, w):
+    mask = np.ones((h, w), dtype=bool)
+    mask[:, :w // 2] = False
+    return np.broadcast_to(mask, (n, h, w))
+
+
+def right_masks(rng, n, h, w):
+    mask = np.ones((h, w), dtype=bool)
+    mask[:, w // 2:] = False
+    return np.broadcast_to(mask, (n, h, w))
+
+
+def full_masks(rng, n, h, w):
+    return np.ones((n, h, w), dtype=bool)
+
+
+def stroke_masks(rng, n, h, w, count=4, vertices=6, radius=None):
+    # Random walks of `vertices` segments, drawn as discs stamped along
+    # every segment
+    count = int(count)
+    radius = radius or max(1, min(h, w) // 16)
+    # About one disc per pixel of the longest possible segment
+    steps = max(h, w) // 4 + 2
+
+    start = rng.random_sample((n, count, 1, 2)) * [h, w]
+    angle = rng.uniform(0, 2 * np.pi, size=(n, count, vertices, 1))
+    length = rng.uniform(0.1, 0.25, size=(n, count, vertices, 1)) * max(h, w)
+    moves = np.concatenate([np.sin(angle), np.cos(angle)], axis=3) * length
+    corners = np.concatenate([start, start + np.cumsum(moves, axis=2)], axis=2)
+
+    t = np.linspace(0, 1, steps).reshape([1, 1, 1, steps, 1])
+    points = corners[:, :, :-1, None] + \
+        t * (corners[:, :, 1:, None] - corners[:, :, :-1, None])
+    points = np.rint(points).astype(int).reshape([n, -1, 1, 2])
+
+    dy, dx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    disc = np.stack([dy, dx], axis=-1)[dy ** 2 + dx ** 2 <= radius ** 2]
+    pixels = points + disc[None, None]
+    ys = np.clip(pixels[..., 0], 0, h - 1)
+    xs = np.clip(pixels[..., 1], 0, w - 1)
+    images = np.broadcast_to(np.arange(n).reshape([n, 1, 1]), ys.shape)
+
+    mask = np.ones((n, h, w), dtype=bool)
+    mask[images, ys, xs] = False
+    return mask
+
+
+def png_masks(rng, n, h, w, path):
+    import scipy.misc
+    if os.path.isdir(path):
+        files = sorted(glob(os.path.join(path, '*.png')))
+    else:
+        files = [path]
+    if not files:
+        raise ValueError('No mask PNGs found in {}'.format(path))
+    masks = []
+    for f in files[:n]:
+        image = scipy.misc.imread(f, flatten=True)
+        if image.shape != (h, w):
+            image = scipy.misc.imresize(image, [h, w], interp='nearest')
+        masks.append(image > 127)
+    return np.resize(np.array(masks), (n, h, w))
+
+
+GENERATORS = {
+    'random': random_masks,
+    'blocks': block_masks,
+    'center': center_masks,
+    'left': left_masks,
+    'right': right_masks,
+    'full': full_masks,
+    'strokes': stroke_masks,
+    'png': png_masks,
+}
+
+DETERMINISTIC = ('center', 'left', 'right', 'full', 'png')
+
+
+def parse_spec(spec):
+    name, _, param = spec.strip().partition(':')
+    if name not in GENERATORS:
+        raise ValueError('Unknown mask type: {}'.format(name))
+    if not param:
+        return name, ()
+    if name == 'png':
+        return name, (param,)
+    return name, (float(param),)
+
+
+def make_masks(spec, n, image_shape, seed=None):
+    """Masks for `n` images of `image_shape` as one float32 array.
+
+    `spec` is a mask spec string (comma separated specs are cycled over the
+    images) or a list with one spec per image. Masks that use no randomness
+    are cached by spec, batch size and shape, whatever the seed, so every
+    batch and request reuses them; the returned array is read-only. Random
+    masks are drawn again on every call, a seeded run gives each batch its
+    own seed and would never hit the cache.
+    """
+    specs = spec.split(',') if isinstance(spec, str) else list(spec)
+    specs = [s.strip() for s in specs]
+    parsed = OrderedDict((s, parse_spec(s)) for s in specs)
+
+    cacheable = all(name in DETERMINISTIC for name, _ in parsed.values())
+    key = (tuple(specs), n, tuple(image_shape))
+    if cacheable and key in _cache:
+        _cache[key] = _cache.pop(key)
+        return _cache[key]
+
+    h, w, c = image_shape
+    rng = np.random.RandomState(seed)
+    assigned = np.array([specs[i % len(specs)] for i in range(n)])
+    masks = np.empty((n, h, w), dtype=bool)
+    for s, (name, params) in parsed.items():
+        # Every distinct spec fills all of its images in one call
+        idxs = np.flatnonzero(assigned == s)
+        if len(idxs):
+            masks[idxs] = GENERATORS[name](rng, len(idxs), h, w, *params)
+
+    masks = np.repeat(masks[:, :, :, None], c, axis=3).astype(np.float32)
+    masks.setflags(write=False)
+    if cacheable:
+        _cache[key] = masks
+        while len(_cache) > MAX_CACHED:
+            _cache.popitem(last=False)
+    return masks
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import numpy as np
+
+# MNIST for DCGAN.train
+# The idx files are memory-mapped and the pixels stay uint8, batches are
+# normalized to float32 and labels one-hot encoded only when taken. The
+# shuffled arrays are saved to mnist.npz next to the idx files, later runs
+# load that instead of parsing again.
+
+SEED = 547
+FILES = [('train-images-idx3-ubyte', 'train-labels-idx1-ubyte'),
+         ('t10k-images-idx3-ubyte', 't10k-labels-idx1-ubyte')]
+CACHE_NAME = 'mnist.npz'
+
+
+def read_idx(path):
+    # Header: two zero bytes, the element type, the number of dimensions
+    # and one big-endian int32 per dimension
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+        ndim = bytearray(magic)[3]
+        shape = tuple(np.frombuffer(f.read(4 * ndim), dtype='>i4'))
+    if bytearray(magic)[2] != 0x08:
+        raise ValueError('{} does not hold unsigned bytes'.format(path))
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=4 + 4 * ndim,
+                     shape=shape)
+
+
+class MnistData(object):
+    """The 70000 train and test digits, shuffled like the original loader
+    (one permutation drawn from SEED)"""
+
+    def __init__(self, data_dir, y_dim=10, cache=True):
+        path = os.path.join(data_dir, CACHE_NAME)
+        if cache and os.path.exists(path):
+            with np.load(path) as f:
+                self.x, self.y = f['x'], f['y']
+        else:
+            x, y = self.parse(data_dir)
+            if cache:
+                fd, tmp = tempfile.mkstemp(dir=data_dir, suffix='.tmp')
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, x=x, y=y)
+                os.replace(tmp, path)
+            self.x, self.y = x, y
+        self.eye = np.eye(y_dim, dtype=np.float32)
+
+    @staticmethod
+    def parse(data_dir):
+        images = [read_idx(os.path.join(data_dir, name)) for name, _ in FILES]
+        labels = [read_idx(os.path.join(data_dir, name)) for _, name in FILES]
+        x = np.concatenate(images, axis=0)[:, :, :, None]
+        y = np.concatenate(labels, axis=0)
+        # np.random.shuffle of X and y with the same seed is this
+        # permutation applied to both
+        order = np.random.RandomState(SEED).permutation(len(x))
+        return x[order], y[order]
+
+    def __len__(self):
+        return len(self.x)
+
+    def images(self, start, end, out=None):
+        # float32 in [0, 1]
+        batch = self.x[start:end]
+        if out is not None:
+            out = out[:len(batch)]
+        return np.multiply(batch, np.float32(1. / 255.), out=out,
+                           dtype=np.float32)
+
+    def labels(self, start, end, out=None):
+        # One-hot rows of the identity matrix
+        return np.take(self.eye, self.y[start:end], axis=0, out=out)
@@ -2,6 +2,8 @@ from __future__ import division
 import os
 import time
 import math
+import json
+import hashlib
 from glob import glob
 import tensorflow as tf
 import numpy as np
@@ -10,6 +12,13 @@ import copy
 
 from ops import *
 from utils import *
+from masks import make_masks
+from writer import SnapshotWriter
+from latents import LatentCache, initial_zhats
+from checkpoints import Manifest
+from convergence import PlateauTracker
+# The input pipeline, the caches and the exporters are imported by the
+# methods that use them, inference processes start without them
 
 # This should be considerated again
 # The original code is modified from DCGAN implementation:
@@ -20,13 +29,45 @@ def conv_out_size_same(size, stride):
     return int(math.ceil(float(size) / float(stride)))
 
 
+def graph_cache_path(cache_dir, **options):
+    """Where DCGAN.save_graph keeps the graph built for `options`. The model
+    sources and the TensorFlow version are part of the key, so changing
+    either builds a new graph."""
+    key = hashlib.sha1()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in ['model.py', 'ops.py']:
+        with open(os.path.join(here, name), 'rb') as f:
+            key.update(f.read())
+    key.update(tf.__version__.encode('utf-8'))
+    key.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+    return os.path.join(cache_dir, key.hexdigest()[:16] + '.meta')
+
+
+def model_architecture(output_height=64, output_width=64, c_dim=3, y_dim=None,
+                       gf_dim=64, df_dim=64, gfc_dim=1024, dfc_dim=1024):
+    """The DCGAN arguments that decide the variable shapes, with the same
+    defaults. Checkpoints with the same architecture can be restored into
+    each other's graphs, whatever batch size or dataset they came from."""
+    return {
+        'output_height': output_height,
+        'output_width': output_width,
+        'c_dim': c_dim,
+        'y_dim': y_dim or 0,
+        'gf_dim': gf_dim,
+        'df_dim': df_dim,
+        'gfc_dim': gfc_dim,
+        'dfc_dim': dfc_dim,
+    }
+
+
 class DCGAN(object):
 
     def __init__(self, sess, input_height=64, input_width=64, is_crop=True,
                  batch_size=64, sample_num=64, output_height=64, output_width=64,
                  y_dim=None, z_dim=100, gf_dim=64, df_dim=64,
                  gfc_dim=1024, dfc_dim=1024, c_dim=3, dataset_name='default',
-                 input_fname_pattern='*.jpg', checkpoint_dir=None, sample_dir=None, lambda_val=0.08, dataset_name2='default'):
+                 input_fname_pattern='*.jpg', checkpoint_dir=None, sample_dir=None, lambda_val=0.08, dataset_name2='default',
+                 summaries=True, graph_file=None):
 
         self.sess = sess
         self.is_crop = is_crop
@@ -41,6 +82,8 @@ class DCGAN(object):
         # labmda value should be relatively small to constrain the recovered
         # image with the input pixels
         self.lambda_val = lambda_val
+        # Reduced by build_inference
+        self.inference_dtype = tf.float32
 
         self.batch_size = batch_size
         self.sample_num = sample_num
@@ -64,6 +107,9 @@ class DCGAN(object):
         self.gfc_dim = gfc_dim
         self.dfc_dim = dfc_dim
         self.c_dim = c_dim
+        self.architecture = model_architecture(
+            output_height, output_width, c_dim, y_dim,
+            gf_dim, df_dim, gfc_dim, dfc_dim)
 
         # batch normalization : deals with poor initialization helps gradient
         # flow
@@ -88,12 +134,18 @@ class DCGAN(object):
         #######################################################################
         self.input_fname_pattern = input_fname_pattern
         self.checkpoint_dir = checkpoint_dir
-        self.build_model()
+        # Inference only processes can skip the summary ops, or import a
+        # graph saved by save_graph instead of building it
+        self.with_summaries = summaries
+        if graph_file:
+            self.load_graph(graph_file)
+        else:
+            self.build_model()
 
     def build_model(self):
         if self.y_dim:
             self.y = tf.placeholder(
-                tf.float32, [self.batch_size, self.y_dim], name='y')
+                tf.float32, [None, self.y_dim], name='y')
 
         if self.is_crop:
             image_dims = [self.output_height, self.output_width, self.c_dim]
@@ -101,16 +153,15 @@ class DCGAN(object):
             image_dims = [self.input_height, self.input_width, self.c_dim]
 
         self.inputs = tf.placeholder(
-            tf.float32, [self.batch_size] + image_dims, name='real_images')
+            tf.float32, [None] + image_dims, name='real_images')
         self.sample_inputs = tf.placeholder(
-            tf.float32, [self.sample_num] + image_dims, name='sample_inputs')
+            tf.float32, [None] + image_dims, name='sample_inputs')
 
         inputs = self.inputs
         sample_inputs = self.sample_inputs
 
         self.z = tf.placeholder(
             tf.float32, [None, self.z_dim], name='z')
-        self.z_sum = histogram_summary("z", self.z)
 
         if self.y_dim:
             self.G = self.generator(self.z, self.y)
@@ -127,16 +178,6 @@ class DCGAN(object):
             self.sampler = self.sampler(self.z)
             self.D_, self.D_logits_ = self.discriminator(self.G, reuse=True)
 
-        self.d_sum = histogram_summary("d", self.D)
-        self.d__sum = histogram_summary("d_", self.D_)
-        self.G_sum = image_summary("G", self.G)
-
-        def sigmoid_cross_entropy_with_logits(x, y):
-            try:
-                return tf.nn.sigmoid_cross_entropy_with_logits(logits=x, labels=y)
-            except:
-                return tf.nn.sigmoid_cross_entropy_with_logits(logits=x, targets=y)
-
         self.d_loss_real = tf.reduce_mean(
             sigmoid_cross_entropy_with_logits(self.D_logits, tf.ones_like(self.D)))
         self.d_loss_fake = tf.reduce_mean(
@@ -144,14 +185,8 @@ class DCGAN(object):
         self.g_loss = tf.reduce_mean(
             sigmoid_cross_entropy_with_logits(self.D_logits_, tf.ones_like(self.D_)))
 
-        self.d_loss_real_sum = scalar_summary("d_loss_real", self.d_loss_real)
-        self.d_loss_fake_sum = scalar_summary("d_loss_fake", self.d_loss_fake)
-
         self.d_loss = self.d_loss_real + self.d_loss_fake
 
-        self.g_loss_sum = scalar_summary("g_loss", self.g_loss)
-        self.d_loss_sum = scalar_summary("d_loss", self.d_loss)
-
         t_vars = tf.trainable_variables()
 
         self.d_vars = [var for var in t_vars if 'd_' in var.name]
@@ -165,7 +200,8 @@ class DCGAN(object):
         # self.d_loss = self.d_loss_real - self.d_loss_fake
         #######################################################################
 
-        self.saver = tf.train.Saver()
+        self.saved_variables = tf.global_variables()
+        self.saver = tf.train.Saver(self.saved_variables)
 
         # For Auto Inpainting
         # Refered http://bamos.github.io/2016/08/09/deep-completion/ and paper: with MIT license
@@ -178,45 +214,145 @@ class DCGAN(object):
             tf.contrib.layers.flatten(
                 tf.abs(tf.multiply(self.mask, self.G) - tf.multiply(self.mask, self.inputs))), 1)
 
-        self.contextual_loss_sum = scalar_summary(
-            "contextual_loss_sum", self.contextual_loss)
-
         # Perceptual loss
         self.perceptual_loss = self.g_loss
 
-        self.perceptual_loss_sum = scalar_summary(
-            "perceptual_loss", self.perceptual_loss)
-
         self.complete_loss = self.contextual_loss + \
             self.lambda_val * self.perceptual_loss
 
+        self.grad_complete_loss = tf.gradients(self.complete_loss, self.z)
+
+        if self.with_summaries:
+            self.build_summaries()
+
+    def build_summaries(self):
+        self.z_sum = histogram_summary("z", self.z)
+
+        self.d_sum = histogram_summary("d", self.D)
+        self.d__sum = histogram_summary("d_", self.D_)
+        self.G_sum = image_summary("G", self.G)
+
+        self.d_loss_real_sum = scalar_summary("d_loss_real", self.d_loss_real)
+        self.d_loss_fake_sum = scalar_summary("d_loss_fake", self.d_loss_fake)
+
+        self.g_loss_sum = scalar_summary("g_loss", self.g_loss)
+        self.d_loss_sum = scalar_summary("d_loss", self.d_loss)
+
+        self.contextual_loss_sum = scalar_summary(
+            "contextual_loss_sum", self.contextual_loss)
+
+        self.perceptual_loss_sum = scalar_summary(
+            "perceptual_loss", self.perceptual_loss)
+
         self.complete_loss_sum = scalar_summary(
             "complete_loss_sum", self.complete_loss)
 
-        self.grad_complete_loss = tf.gradients(self.complete_loss, self.z)
-
         self.grad_complete_loss_sum = scalar_summary(
             "grad_complete_loss", self.grad_complete_loss)
 
+    # Tensors and ops an inference process needs, kept by name in a saved
+    # graph so load_graph can bind them again without rebuilding it
+    GRAPH_TENSORS = ['z', 'inputs', 'mask', 'G', 'sampler', 'contextual_loss',
+                     'perceptual_loss', 'complete_loss', 'grad_complete_loss',
+                     'loop_z', 'loop_v', 'loop_best_z', 'loop_best_loss',
+                     'loop_images', 'loop_mask', 'loop_z_in', 'loop_init',
+                     'loop_steps', 'loop_active', 'loop_run', 'loop_G',
+                     'loop_contextual_loss', 'loop_complete_loss',
+                     'loop_next_best_loss']
+
+    def save_graph(self, path):
+        """Write the built graph and the GRAPH_TENSORS in it to `path`"""
+        graph = tf.get_default_graph()
+        tensors = [(name, getattr(self, name)) for name in self.GRAPH_TENSORS
+                   if hasattr(self, name)]
+        tensors += [('float32/' + name, tensor)
+                    for name, tensor in getattr(self, 'float32', {}).items()]
+        for name, tensor in tensors:
+            if isinstance(tensor, list):
+                tensor = tensor[0]
+            if isinstance(tensor, tf.Variable):
+                tensor = tensor.value()
+            graph.clear_collection('xgan/' + name)
+            graph.add_to_collection('xgan/' + name, tensor)
+        graph.clear_collection('xgan_inference_dtype')
+        graph.add_to_collection('xgan_inference_dtype',
+                                self.inference_dtype.name)
+        tf.train.export_meta_graph(filename=path, saver_def=self.saver.as_saver_def())
+
+    def load_graph(self, path):
+        """Import a graph written by `save_graph` instead of building one"""
+        self.saver = tf.train.import_meta_graph(path)
+        self.float32 = {}
+        graph = tf.get_default_graph()
+        for key in graph.get_all_collection_keys():
+            if not key.startswith('xgan/'):
+                continue
+            name = key[len('xgan/'):]
+            tensor = graph.get_collection(key)[0]
+            if name.endswith('grad_complete_loss'):
+                tensor = [tensor]
+            if name.startswith('float32/'):
+                self.float32[name[len('float32/'):]] = tensor
+            else:
+                setattr(self, name, tensor)
+        self.inference_dtype = tf.as_dtype(tf.compat.as_str(
+            graph.get_collection('xgan_inference_dtype')[0]))
+        if not self.float32:
+            del self.float32
+
     def train(self, config):
         """Train DCGAN"""
+        from loader import BatchBuffers, BatchLoader, EpochSampler, image_loader
+        from cache import PackedDataset
+        from checkpoints import CheckpointWriter, Retention
+
+        packed = None
         if config.dataset == 'mnist':
-            data_X, data_y = self.load_mnist()
+            mnist = self.load_mnist()
+        elif config.cache_file:
+            # Read pre-decoded batches from the packed cache
+            packed = PackedDataset(config.cache_file)
+            packed.check(self.input_height, self.input_width,
+                         self.output_height, self.output_width,
+                         self.is_crop, self.is_grayscale)
+            data = packed.files('dataset')
+            data2 = packed.files('dataset2')
         else:
-            data = glob(os.path.join(
-                "./data", config.dataset, self.input_fname_pattern))
-            # np.random.shuffle(data)
+            data = sorted(glob(os.path.join(
+                "./data", config.dataset, self.input_fname_pattern)))
 
             # Xz-GAN
             ###################################################################
-            data2 = glob(os.path.join(
-                "./data", config.dataset2, self.input_fname_pattern))
+            data2 = sorted(glob(os.path.join(
+                "./data", config.dataset2, self.input_fname_pattern)))
             ###################################################################
 
-        d_optim = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1) \
-            .minimize(self.d_loss, var_list=self.d_vars)
-        g_optim = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1) \
-            .minimize(self.g_loss, var_list=self.g_vars)
+        use_data2 = config.z_source == 'dataset2'
+        if config.dataset != 'mnist':
+            # Both file lists are read once, every epoch streams a new
+            # permutation of them
+            sampler = EpochSampler(
+                data, data2, config.batch_size,
+                seed=config.shuffle_seed if config.shuffle_seed >= 0 else None,
+                shuffle=config.shuffle, pair_by_name=config.pair_by_name,
+                use_files2=use_data2)
+            if use_data2:
+                assert(self.output_height * self.output_width *
+                       self.c_dim == self.z_dim)
+
+        d_optimizer = tf.train.AdamOptimizer(
+            config.learning_rate, beta1=config.beta1)
+        g_optimizer = tf.train.AdamOptimizer(
+            config.learning_rate, beta1=config.beta1)
+        if config.num_towers > 1:
+            d_optim, g_optim, d_loss_real, d_loss_fake, g_loss = \
+                self.build_towers(config.num_towers, config.tower_device,
+                                  d_optimizer, g_optimizer)
+        else:
+            d_optim = d_optimizer.minimize(self.d_loss, var_list=self.d_vars)
+            g_optim = g_optimizer.minimize(self.g_loss, var_list=self.g_vars)
+            d_loss_real, d_loss_fake, g_loss = \
+                self.d_loss_real, self.d_loss_fake, self.g_loss
 
         # Wasserstein-GAN
         #######################################################################
@@ -231,10 +367,38 @@ class DCGAN(object):
             # Fit for different APIs of Tensorflow
             tf.initialize_all_variables().run()
 
-        self.g_sum = merge_summary(
-            [self.z_sum, self.d__sum, self.G_sum, self.d_loss_fake_sum, self.g_loss_sum])
-        self.d_sum = merge_summary(
-            [self.z_sum, self.d_sum, self.d_loss_real_sum, self.d_loss_sum])
+        # A model built without summaries (summaries=False) gets them now
+        if not self.with_summaries:
+            self.build_summaries()
+            self.with_summaries = True
+
+        # Summaries are grouped by cost so that every group can be written
+        # at its own interval, see summaries()
+        if config.num_towers > 1:
+            # Log the tower losses and the first tower's outputs, the single
+            # device ones would run the whole batch once more
+            tower = self.tower_outputs
+            with tf.name_scope('towers'):
+                self.z_sum = histogram_summary("z", tower['z'])
+                self.d_sum = histogram_summary("d", tower['D'])
+                self.d__sum = histogram_summary("d_", tower['D_'])
+                self.G_sum = image_summary("G", tower['G'])
+                self.d_loss_real_sum = scalar_summary(
+                    "d_loss_real", d_loss_real)
+                self.d_loss_fake_sum = scalar_summary(
+                    "d_loss_fake", d_loss_fake)
+                self.g_loss_sum = scalar_summary("g_loss", g_loss)
+                self.d_loss_sum = scalar_summary(
+                    "d_loss", d_loss_real + d_loss_fake)
+        self.scalar_sums = {
+            'd': merge_summary([self.d_loss_real_sum, self.d_loss_sum]),
+            'g': merge_summary([self.d_loss_fake_sum, self.g_loss_sum]),
+        }
+        self.histogram_sums = {
+            'd': merge_summary([self.z_sum, self.d_sum]),
+            'g': self.d__sum,
+        }
+        self.image_sums = {'g': self.G_sum}
         self.inpaint_sum = merge_summary(
             [self.contextual_loss_sum, self.perceptual_loss_sum, self.complete_loss_sum, self.grad_complete_loss_sum])
         self.writer = SummaryWriter("./logs", self.sess.graph)
@@ -242,10 +406,21 @@ class DCGAN(object):
         sample_z = np.random.uniform(-1, 1, size=(self.sample_num, self.z_dim))
 
         if config.dataset == 'mnist':
-            sample_inputs = data_X[0:self.sample_num]
-            sample_labels = data_y[0:self.sample_num]
+            sample_inputs = mnist.images(0, self.sample_num)
+            sample_labels = mnist.labels(0, self.sample_num)
+        elif packed is not None:
+            sample_inputs = packed.take(
+                'dataset', sampler.indices[:self.sample_num])
+            # Xz-GAN
+            ###################################################################
+            sample_noisy = packed.take(
+                'dataset2', sampler.indices2[:self.sample_num])
+            if not self.is_grayscale:
+                sample_z = sample_noisy.reshape([len(sample_noisy), -1])
+            ###################################################################
         else:
-            sample_files = data[0:self.sample_num]
+            sample_files = [data[i]
+                            for i in sampler.indices[:self.sample_num]]
             sample = [
                 get_image(sample_file,
                           input_height=self.input_height,
@@ -256,7 +431,8 @@ class DCGAN(object):
                           is_grayscale=self.is_grayscale) for sample_file in sample_files]
             # Xz-GAN
             ###################################################################
-            sample_zs = data2[0:self.sample_num]
+            sample_zs = [data2[i]
+                         for i in sampler.indices2[:self.sample_num]]
             sample_2 = [
                 get_image(sample_file,
                           input_height=self.input_height,
@@ -282,9 +458,56 @@ class DCGAN(object):
                 sample_z = np.array(sample_2).astype(np.float32)
                 ###############################################################
 
+        # Sample grids are assembled and encoded off the training thread
+        snapshot_writer = SnapshotWriter(config.snapshot_queue,
+                                         config.snapshot_policy)
+
+        # Batches and noise are written into the same float32 arrays every
+        # step instead of allocating new ones
+        buffers = BatchBuffers()
+        ring_size = max(1, config.prefetch_batches) + 2
+        d_ring = buffers.ring('dataset', ring_size,
+                              [config.batch_size, self.output_height,
+                               self.output_width, self.c_dim])
+        # Xz-GAN
+        #######################################################################
+        g_ring = buffers.ring('dataset2', ring_size,
+                              [config.batch_size, self.output_height *
+                               self.output_width * self.c_dim])
+        #######################################################################
+
+        # Python side allocations of every step, numpy arrays included.
+        # tracemalloc sees all threads, so loader workers count as well
+        if config.trace_allocations:
+            import tracemalloc
+            tracemalloc.start()
+
+        # Checkpoints are fetched into memory and written by a background
+        # thread while training continues
+        def log_checkpoint(step, snapshot_time, write_time):
+            self.writer.add_summary(tf.Summary(value=[
+                tf.Summary.Value(tag='checkpoint/snapshot_seconds',
+                                 simple_value=snapshot_time),
+                tf.Summary.Value(tag='checkpoint/write_seconds',
+                                 simple_value=write_time)]), step)
+
+        self.checkpoint_writer = CheckpointWriter(
+            self.sess, self.saved_variables,
+            retention=Retention(config.keep_checkpoints,
+                                config.keep_checkpoint_hours,
+                                config.keep_best),
+            background=config.async_checkpoint,
+            log=log_checkpoint,
+            manifest=Manifest(config.checkpoint_dir,
+                              verify=config.verify_checkpoints),
+            architecture=self.architecture,
+            hparams=self.hparams(config))
+
         counter = 1
         start_time = time.time()
-        could_load, checkpoint_counter = self.load(self.checkpoint_dir)
+        could_load, checkpoint_counter = self.load(
+            self.checkpoint_dir, same_dataset=True,
+            verify=config.verify_checkpoints)
         if could_load:
             counter = checkpoint_counter
             print(" [***] Load SUCCESS")
@@ -294,114 +517,147 @@ class DCGAN(object):
         for epoch in xrange(config.epoch):
             if config.dataset == 'mnist':
                 batch_idxs = min(
-                    len(data_X), config.train_size) // config.batch_size
+                    len(mnist), config.train_size) // config.batch_size
             else:
-                data = glob(os.path.join(
-                    "./data", config.dataset, self.input_fname_pattern))
+                epoch_batches, epoch_batches2 = sampler.epoch(
+                    config.train_size)
+                batch_idxs = len(epoch_batches)
+
+            if config.dataset != 'mnist' and packed is None:
+                # Decode upcoming batches in the background so sess.run
+                # does not wait on scipy
+                load_fn = image_loader(self.input_height, self.input_width,
+                                       resize_height=self.output_height,
+                                       resize_width=self.output_width,
+                                       is_crop=self.is_crop,
+                                       is_grayscale=self.is_grayscale)
+                d_loader = BatchLoader(
+                    [[data[i] for i in batch] for batch in epoch_batches],
+                    load_fn, is_grayscale=self.is_grayscale,
+                    num_workers=config.loader_workers,
+                    prefetch=config.prefetch_batches,
+                    use_processes=config.loader_processes,
+                    ring=d_ring)
                 # Xz-GAN
                 ###############################################################
-                data2 = glob(os.path.join(
-                    "./data", config.dataset2, self.input_fname_pattern))
+                # dataset2 is only decoded when it is fed as z
+                g_loader = BatchLoader(
+                    [[data2[i] for i in batch] for batch in epoch_batches2]
+                    if use_data2 else [],
+                    load_fn, flatten=True,
+                    num_workers=config.loader_workers,
+                    prefetch=config.prefetch_batches,
+                    use_processes=config.loader_processes,
+                    ring=g_ring)
                 ###############################################################
 
-                batch_idxs = min(
-                    len(data), config.train_size) // config.batch_size
-
             for idx in xrange(0, batch_idxs):
+                if config.trace_allocations:
+                    tracemalloc.clear_traces()
                 if config.dataset == 'mnist':
-                    batch_images = data_X[
-                        idx * config.batch_size:(idx + 1) * config.batch_size]
-                    batch_labels = data_y[
-                        idx * config.batch_size:(idx + 1) * config.batch_size]
+                    batch_images = mnist.images(
+                        idx * config.batch_size, (idx + 1) * config.batch_size,
+                        out=buffers.get('mnist', (config.batch_size,) +
+                                        mnist.x.shape[1:]))
+                    batch_labels = mnist.labels(
+                        idx * config.batch_size, (idx + 1) * config.batch_size,
+                        out=buffers.get('labels', [config.batch_size,
+                                                   self.y_dim]))
+                elif packed is not None:
+                    batch_images = packed.take(
+                        'dataset', epoch_batches[idx], out=d_ring[0])
+                    # Xz-GAN
+                    ###########################################################
+                    if use_data2:
+                        batch_z = packed.take(
+                            'dataset2', epoch_batches2[idx], flatten=True,
+                            out=g_ring[0])
+                    ###########################################################
                 else:
-                    batch_files = data[
-                        idx * config.batch_size:(idx + 1) * config.batch_size]
-                    batch = [
-                        get_image(batch_file,
-                                  input_height=self.input_height,
-                                  input_width=self.input_width,
-                                  resize_height=self.output_height,
-                                  resize_width=self.output_width,
-                                  is_crop=self.is_crop,
-                                  is_grayscale=self.is_grayscale) for batch_file in batch_files]
+                    batch_images = next(d_loader)
                     # Xz-GAN
                     ###########################################################
-                    batch_zs = data2[0:self.sample_num]
-                    batch_2 = [
-                        get_image(batch_file,
-                                  input_height=self.input_height,
-                                  input_width=self.input_width,
-                                  resize_height=self.output_height,
-                                  resize_width=self.output_width,
-                                  is_crop=self.is_crop,
-                                  is_grayscale=self.is_grayscale).reshape([self.z_dim]) for batch_file in batch_zs]
+                    if use_data2:
+                        batch_z = next(g_loader)
                     ###########################################################
+                if config.dataset == 'mnist' or not use_data2:
+                    batch_z = buffers.uniform(
+                        'z', [config.batch_size, self.z_dim], -1, 1)
+
+                d_sums = self.summaries('d', counter, config)
+                g_sums = self.summaries('g', counter, config)
+
+                if config.fused_step:
+                    # The logged losses are fetched by the update runs
+                    # themselves, i.e. they are the values the optimizers
+                    # stepped from, instead of being recomputed afterwards
+                    d_feed = {self.inputs: batch_images, self.z: batch_z}
+                    g_feed = {self.z: batch_z}
+                    if config.dataset == 'mnist':
+                        d_feed[self.y] = batch_labels
+                        g_feed[self.y] = batch_labels
 
-                    if (self.is_grayscale):
-                        batch_images = np.array(batch).astype(
-                            np.float32)[:, :, :, None]
-                    else:
-                        batch_images = np.array(batch).astype(np.float32)
-
-                        # Xz-GAN
-                        #######################################################
-                        batch_z = np.array(batch_2).astype(np.float32)
-                        #######################################################
-                batch_z = np.random.uniform(-1, 1, [config.batch_size, self.z_dim]) \
-                    .astype(np.float32)
-
-                if config.dataset == 'mnist':
                     # Update D network
-                    _, summary_str = self.sess.run([d_optim, self.d_sum],
-                                                   feed_dict={
+                    _, summary_strs, errD_fake, errD_real = self.sess.run(
+                        [d_optim, d_sums, d_loss_fake, d_loss_real],
+                        feed_dict=d_feed)
+                    self.add_summaries(summary_strs, counter)
+
+                    # Update G network twice, see below
+                    self.sess.run(g_optim, feed_dict=g_feed)
+                    _, summary_strs, errG = self.sess.run(
+                        [g_optim, g_sums, g_loss], feed_dict=g_feed)
+                    self.add_summaries(summary_strs, counter)
+                    session_runs = 3
+                elif config.dataset == 'mnist':
+                    # Update D network
+                    _, summary_strs = self.sess.run([d_optim, d_sums],
+                                                    feed_dict={
                         self.inputs: batch_images,
                         self.z: batch_z,
                         self.y: batch_labels,
                     })
-                    self.writer.add_summary(summary_str, counter)
+                    self.add_summaries(summary_strs, counter)
 
                     # Update G network
-                    _, summary_str = self.sess.run([g_optim, self.g_sum],
-                                                   feed_dict={
-                        self.z: batch_z,
-                        self.y: batch_labels,
-                    })
-                    self.writer.add_summary(summary_str, counter)
+                    self.sess.run(g_optim,
+                                  feed_dict={
+                                      self.z: batch_z,
+                                      self.y: batch_labels,
+                                  })
 
                     # Run g_optim twice to make sure that d_loss does not go to
                     # zero (different from paper)
-                    _, summary_str = self.sess.run([g_optim, self.g_sum],
-                                                   feed_dict={self.z: batch_z, self.y: batch_labels})
-                    self.writer.add_summary(summary_str, counter)
+                    _, summary_strs = self.sess.run([g_optim, g_sums],
+                                                    feed_dict={self.z: batch_z, self.y: batch_labels})
+                    self.add_summaries(summary_strs, counter)
 
-                    errD_fake = self.d_loss_fake.eval({
+                    errD_fake = d_loss_fake.eval({
                         self.z: batch_z,
                         self.y: batch_labels
                     })
-                    errD_real = self.d_loss_real.eval({
+                    errD_real = d_loss_real.eval({
                         self.inputs: batch_images,
                         self.y: batch_labels
                     })
-                    errG = self.g_loss.eval({
+                    errG = g_loss.eval({
                         self.z: batch_z,
                         self.y: batch_labels
                     })
                 else:
                     # Update D network
-                    _, summary_str = self.sess.run([d_optim, self.d_sum],
-                                                   feed_dict={self.inputs: batch_images, self.z: batch_z})
-                    self.writer.add_summary(summary_str, counter)
+                    _, summary_strs = self.sess.run([d_optim, d_sums],
+                                                    feed_dict={self.inputs: batch_images, self.z: batch_z})
+                    self.add_summaries(summary_strs, counter)
 
                     # Update G network
-                    _, summary_str = self.sess.run([g_optim, self.g_sum],
-                                                   feed_dict={self.z: batch_z})
-                    self.writer.add_summary(summary_str, counter)
+                    self.sess.run(g_optim, feed_dict={self.z: batch_z})
 
                     # Run g_optim twice to make sure that d_loss does not go to
                     # zero (different from paper)
-                    _, summary_str = self.sess.run([g_optim, self.g_sum],
-                                                   feed_dict={self.z: batch_z})
-                    self.writer.add_summary(summary_str, counter)
+                    _, summary_strs = self.sess.run([g_optim, g_sums],
+                                                    feed_dict={self.z: batch_z})
+                    self.add_summaries(summary_strs, counter)
 
                     ###########################################################
                     # Wasserstein-GAN
@@ -416,14 +672,29 @@ class DCGAN(object):
                     #    self.writer.add_summary(summary_str, counter)
                     ###########################################################
 
-                    errD_fake = self.d_loss_fake.eval({self.z: batch_z})
-                    errD_real = self.d_loss_real.eval(
+                    errD_fake = d_loss_fake.eval({self.z: batch_z})
+                    errD_real = d_loss_real.eval(
                         {self.inputs: batch_images})
-                    errG = self.g_loss.eval({self.z: batch_z})
+                    errG = g_loss.eval({self.z: batch_z})
+                if not config.fused_step:
+                    # The D update, two G updates and three loss evals
+                    session_runs = 6
+
+                # sess.run calls of this step, not network evaluations: the
+                # D update alone runs G once and D twice
+                if self.summary_due(config.summary_scalars, counter):
+                    self.writer.add_summary(tf.Summary(value=[tf.Summary.Value(
+                        tag='session_runs', simple_value=session_runs)]), counter)
 
                 counter += 1
-                print("Epoch: [%2d] [%4d/%4d] time: %4.4f, d_loss: %.8f, g_loss: %.8f" % (epoch, idx, batch_idxs,
-                                                                                          time.time() - start_time, errD_fake + errD_real, errG))
+                allocated = ''
+                if config.trace_allocations:
+                    # Peak bytes allocated since the step began
+                    allocated = ", alloc: %dKB" % (
+                        tracemalloc.get_traced_memory()[1] // 1024)
+                print("Epoch: [%2d] [%4d/%4d] time: %4.4f, d_loss: %.8f, g_loss: %.8f, runs: %d%s" % (epoch, idx, batch_idxs,
+                                                                                                      time.time() - start_time, errD_fake + errD_real, errG,
+                                                                                                      session_runs, allocated))
 
                 if np.mod(counter, 100) == 1:
                     if config.dataset == 'mnist':
@@ -437,8 +708,9 @@ class DCGAN(object):
                         )
                         manifold_h = int(np.ceil(np.sqrt(samples.shape[0])))
                         manifold_w = int(np.floor(np.sqrt(samples.shape[0])))
-                        save_images(samples, [manifold_h, manifold_w],
-                                    './{}/train_{:02d}_{:04d}.png'.format(config.sample_dir, epoch, idx))
+                        snapshot_writer.submit(
+                            save_images, samples, [manifold_h, manifold_w],
+                            './{}/train_{:02d}_{:04d}.png'.format(config.sample_dir, epoch, idx))
                         print("[Sample] d_loss: %.8f, g_loss: %.8f" %
                               (d_loss, g_loss))
                     else:
@@ -454,14 +726,16 @@ class DCGAN(object):
                                 np.ceil(np.sqrt(samples.shape[0])))
                             manifold_w = int(
                                 np.floor(np.sqrt(samples.shape[0])))
-                            save_images(samples, [manifold_h, manifold_w],
-                                        './{}/train_{:02d}_{:04d}.png'.format(config.sample_dir, epoch, idx))
+                            snapshot_writer.submit(
+                                save_images, samples, [manifold_h, manifold_w],
+                                './{}/train_{:02d}_{:04d}.png'.format(config.sample_dir, epoch, idx))
                             # Xz-GAN
                             ###################################################
                             sample_noisy = np.asarray(sample_noisy)
                             print(sample_noisy.shape)
-                            save_images(sample_noisy, [
-                                        manifold_h, manifold_w], './{}/noisy_{:02d}_{:04d}.png'.format(config.sample_dir, epoch, idx))
+                            snapshot_writer.submit(
+                                save_images, sample_noisy, [manifold_h, manifold_w],
+                                './{}/noisy_{:02d}_{:04d}.png'.format(config.sample_dir, epoch, idx))
                             ###################################################
                             print("[Sample] d_loss: %.8f, g_loss: %.8f" %
                                   (d_loss, g_loss))
@@ -469,117 +743,688 @@ class DCGAN(object):
                             print("one pic error!...")
 
                 if np.mod(counter, 500) == 2:
-                    self.save(config.checkpoint_dir, counter)
+                    if config.best_metric == 'd_loss':
+                        metric = errD_fake + errD_real
+                    else:
+                        metric = errG
+                    self.save(config.checkpoint_dir, counter,
+                              metric=float(metric))
+
+            if config.dataset != 'mnist' and packed is None:
+                d_stats, g_stats = d_loader.stats(), g_loader.stats()
+                print(" [*] Input stall: D stream %.4fs (%.4fs/batch), G stream %.4fs (%.4fs/batch)" % (
+                    d_stats['stall_time'], d_stats['avg_stall'],
+                    g_stats['stall_time'], g_stats['avg_stall']))
+                d_loader.close()
+                g_loader.close()
+
+        if config.trace_allocations:
+            tracemalloc.stop()
+        snapshot_writer.close()
+        self.checkpoint_writer.close()
+        print(" [*] %d checkpoints, training waited %.2fs for them, %.2fs were written in the background" % (
+            self.checkpoint_writer.saves, self.checkpoint_writer.stall_time,
+            self.checkpoint_writer.write_time))
+        self.checkpoint_writer = None
     # Class method for inpainting
 
     def inpaint(self, config):
         to_file_inpaint = []
 
-        os.makedirs(os.path.join(config.outDir, 'hats_imgs'), exist_ok=True)
-        os.makedirs(os.path.join(config.outDir, 'inpainted'), exist_ok=True)
+        # Shards keep their grids and logs apart, completed images of all
+        # shards go to the shared completed/ directory
+        outDir = config.outDir
+        if config.num_shards > 1:
+            outDir = os.path.join(
+                config.outDir, 'shard_{}'.format(config.shard_index))
+        os.makedirs(os.path.join(outDir, 'hats_imgs'), exist_ok=True)
+        os.makedirs(os.path.join(outDir, 'inpainted'), exist_ok=True)
+        os.makedirs(os.path.join(config.outDir, 'completed'), exist_ok=True)
+
+        if config.in_graph and not hasattr(self, 'loop_run'):
+            self.build_inpaint_loop(config.lr, config.momentum)
 
         # tf.initialize_all_variables().run()
         tf.global_variables_initializer().run()
 
-        isLoaded = self.load(self.checkpoint_dir)
+        isLoaded = self.restore(self.checkpoint_dir, config.weights,
+                                verify=config.verify_checkpoints)
         # Check if the model loaded
         assert(isLoaded[0])
-
-        nImgs = len(config.imgs)
+        if self.inference_dtype != tf.float32:
+            self.check_inference(self.batch_size)
 
         # Deal with path list
-        img_list = glob(os.path.join(config.imgs, '*.jpg'))
-
-        batch_idxs = int(np.ceil(nImgs / self.batch_size))
-        if config.maskType == 'random':
-            fraction_masked = 0.2
-            mask = np.ones(self.image_shape)
-            mask[np.random.random(self.image_shape[:2]) <
-                 fraction_masked] = 0.0
-        elif config.maskType == 'center':
-            scale = 0.25
-            assert(scale <= 0.5)
-            mask = np.ones(self.image_shape)
-            sz = self.image_size
-            l = int(self.image_size * scale)
-            u = int(self.image_size * (1.0 - scale))
-            mask[l:u, l:u, :] = 0.0
-        elif config.maskType == 'left':
-            mask = np.ones(self.image_shape)
-            c = self.image_size // 2
-            mask[:, :c, :] = 0.0
-        elif config.maskType == 'full':
-            mask = np.ones(self.image_shape)
+        packed = None
+        if config.cache_file:
+            from cache import PackedDataset
+            packed = PackedDataset(config.cache_file)
+            packed.check(self.image_size, self.image_size,
+                         self.output_height, self.output_width,
+                         self.is_crop, False)
+            img_list = packed.files('imgs')
         else:
-            assert(False)
+            img_list = sorted(glob(os.path.join(config.imgs, '*.jpg')))
+
+        # Take every num_shards-th image for this shard and skip images
+        # completed by an earlier run
+        img_idxs = list(xrange(len(img_list)))
+        if config.num_shards > 1:
+            img_idxs = img_idxs[config.shard_index::config.num_shards]
+        todo = [i for i in img_idxs
+                if not os.path.exists(completed_path(config.outDir, img_list[i]))]
+        if len(todo) < len(img_idxs):
+            print(" [*] Skipping {} completed images".format(
+                len(img_idxs) - len(todo)))
+        # Logs are appended batch by batch, a resumed run continues them
+        log_path = os.path.join(outDir, 'Inpaint_Results.txt')
+        records_path = os.path.join(outDir, 'results.jsonl')
+        convergence_path = os.path.join(outDir, 'convergence.jsonl')
+        if len(todo) == len(img_idxs):
+            for path in [log_path, records_path, convergence_path]:
+                open(path, 'w').close()
+        img_idxs = todo
+        img_list = [img_list[i] for i in img_idxs]
+
+        nImgs = len(img_list)
+
+        # Every image takes `restarts` consecutive slots of the batch, each
+        # slot starting from its own random z
+        restarts = max(1, config.restarts)
+        imgsPerBatch = self.batch_size // restarts
+        assert(imgsPerBatch > 0)
+
+        batch_idxs = int(np.ceil(nImgs / imgsPerBatch))
+
+        latent_cache = None
+        if config.latent_cache:
+            latent_cache = LatentCache(config.latent_cache)
+
+        # Grids are assembled and encoded off the optimization thread
+        snapshot_writer = SnapshotWriter(config.snapshot_queue,
+                                         config.snapshot_policy)
 
         for idx in xrange(0, batch_idxs):
-            l = idx * self.batch_size
-            u = min((idx + 1) * self.batch_size, nImgs)
+            l = idx * imgsPerBatch
+            u = min((idx + 1) * imgsPerBatch, nImgs)
             batchSz = u - l
             batch_files = img_list[l:u]
-            batch = [get_image(batch_file, self.image_size, self.image_size, is_crop=self.is_crop)
-                     for batch_file in batch_files]
-            batch_images = np.array(batch).astype(np.float32)
-            if batchSz < self.batch_size:
-                print(batchSz)
-                padSz = ((0, int(self.batch_size - batchSz)),
-                         (0, 0), (0, 0), (0, 0))
-                batch_images = np.pad(batch_images, padSz, 'constant')
-                batch_images = batch_images.astype(np.float32)
-
-            batch_mask = np.resize(mask, [self.batch_size] + self.image_shape)
-            zhats = np.random.uniform(-1, 1,
-                                      size=(self.batch_size, self.z_dim))
-            v = 0
-
+            if packed is not None:
+                batch_images = packed.take('imgs', img_idxs[l:u])
+            else:
+                batch = [get_image(batch_file, self.image_size, self.image_size, is_crop=self.is_crop)
+                         for batch_file in batch_files]
+                batch_images = np.array(batch).astype(np.float32)
+            if restarts > 1:
+                batch_images = np.repeat(batch_images, restarts, axis=0)
+
+            # Index of the first slot of each image
+            firsts = np.arange(batchSz) * restarts
+
+            # One mask per image, shared by its restarts. The last batch is
+            # not padded, the graph takes any batch size
+            seed = config.mask_seed + idx if config.mask_seed >= 0 else None
+            batch_mask = make_masks(config.maskType, batchSz,
+                                    self.image_shape, seed=seed)
+            if restarts > 1:
+                batch_mask = np.repeat(batch_mask, restarts, axis=0)
+            zhats = initial_zhats(config.init, batch_images[firsts],
+                                  batch_mask[firsts], self.z_dim,
+                                  restarts=restarts, cache=latent_cache)
+
+            # Grids are named by batch so later batches keep earlier ones
+            prefix = '{:04d}_'.format(idx)
             nRows = np.ceil(batchSz / 8)
             nCols = 8
-            save_images_inpaint(batch_images[:batchSz, :, :, :], [nRows, nCols],
-                                os.path.join(config.outDir, 'before.png'))
-
             masked_images = np.multiply(batch_images, batch_mask)
+            if config.grids:
+                snapshot_writer.submit(
+                    save_images, batch_images[firsts], [nRows, nCols],
+                    os.path.join(outDir, prefix + 'before.png'))
+                snapshot_writer.submit(
+                    save_images, masked_images[firsts], [nRows, nCols],
+                    os.path.join(outDir, prefix + 'masked.png'))
+
+            # Stop images whose best restart stopped improving
+            plateau = PlateauTracker(batchSz, restarts,
+                                     config.plateau_iters, config.plateau_tol)
+            snapshot = InpaintSnapshot(outDir, masked_images, batch_mask,
+                                       batchSz, restarts, to_file_inpaint,
+                                       snapshot_writer, prefix=prefix,
+                                       grids=config.grids)
+
+            if config.in_graph:
+                best_loss, best_zhats = self.inpaint_batch_in_graph(
+                    config, zhats, batch_images, batch_mask, plateau, snapshot)
+            else:
+                best_loss, best_zhats = self.inpaint_batch(
+                    config, zhats, batch_images, batch_mask, plateau, snapshot)
+
+            # Complete every image from the z of its best restart
+            best = snapshot.pick(best_loss)
+            completed = self.complete(
+                best_zhats, batch_images, batch_mask)[best]
+            if config.grids:
+                snapshot_writer.submit(
+                    save_images, completed, [nRows, nCols],
+                    os.path.join(outDir, prefix + 'completed.png'))
+
+            # Stream every completed image as soon as its batch is done,
+            # its record is only appended once the image is written
+            convergence = plateau.report(batch_files)
+            for n, (image, batch_file) in enumerate(zip(completed, batch_files)):
+                path = completed_path(config.outDir, batch_file)
+                snapshot_writer.submit_always(
+                    save_completed, image, path, records_path, {
+                        'file': batch_file,
+                        'output': path,
+                        'contextual_loss': float(best_loss[best[n]]),
+                        'restart': int(best[n] - firsts[n]),
+                        'stopped_at': convergence[n]['stopped_at'],
+                        'batch': idx,
+                    })
+            snapshot_writer.submit_always(
+                append_records, convergence_path, convergence)
+            print(' [*] {}/{} images converged early'.format(
+                int((plateau.stopped >= 0).sum()), batchSz))
+            if latent_cache is not None:
+                for n in xrange(batchSz):
+                    latent_cache.put(batch_images[firsts[n]],
+                                     best_zhats[best[n]])
+
+            print('Best Contextual Loss: {}'.format(np.mean(best_loss[best])))
+            to_file_inpaint.append({'best': np.mean(best_loss[best])})
+            with open(log_path, 'a') as f:
+                for data_item in to_file_inpaint:
+                    f.write(str(data_item) + '\n')
+            del to_file_inpaint[:]
+        snapshot_writer.close()
+        if latent_cache is not None:
+            print(" [*] Latent cache: {} hits, {} misses".format(
+                latent_cache.hits, latent_cache.misses))
+
+    def build_towers(self, num_towers, device_type, d_optimizer, g_optimizer):
+        """Data-parallel D and G updates over `num_towers` devices.
+
+        The fed batch is split evenly, every tower runs the shared generator
+        and discriminator on its share and the optimizers apply the
+        gradients averaged over the towers. With `device_type` 'cpu' the
+        towers are placed on CPU devices, the session needs that many of
+        them (see main.py). The z, D and G tensors of the first tower are
+        kept in `self.tower_outputs` for the summaries.
+        """
+        inputs = tf.split(self.inputs, num_towers)
+        zs = tf.split(self.z, num_towers)
+        if self.y_dim:
+            ys = tf.split(self.y, num_towers)
+        else:
+            ys = [None] * num_towers
+
+        d_grads, g_grads = [], []
+        d_losses_real, d_losses_fake, g_losses = [], [], []
+        for i in xrange(num_towers):
+            with tf.device('/{}:{}'.format(device_type, i)), \
+                    tf.name_scope('tower_{}'.format(i)), \
+                    tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                G = self.generator(zs[i], ys[i])
+                D, D_logits = self.discriminator(inputs[i], ys[i], reuse=True)
+                D_, D_logits_ = self.discriminator(G, ys[i], reuse=True)
+
+                d_loss_real = tf.reduce_mean(
+                    sigmoid_cross_entropy_with_logits(D_logits, tf.ones_like(D)))
+                d_loss_fake = tf.reduce_mean(
+                    sigmoid_cross_entropy_with_logits(D_logits_, tf.zeros_like(D_)))
+                g_loss = tf.reduce_mean(
+                    sigmoid_cross_entropy_with_logits(D_logits_, tf.ones_like(D_)))
+
+                d_grads.append(d_optimizer.compute_gradients(
+                    d_loss_real + d_loss_fake, var_list=self.d_vars))
+                g_grads.append(g_optimizer.compute_gradients(
+                    g_loss, var_list=self.g_vars))
+                d_losses_real.append(d_loss_real)
+                d_losses_fake.append(d_loss_fake)
+                g_losses.append(g_loss)
+                if i == 0:
+                    self.tower_outputs = {'z': zs[i], 'D': D, 'D_': D_,
+                                          'G': G}
+
+        def average(tower_grads):
+            return [(tf.reduce_mean(tf.stack([g for g, _ in grads]), 0),
+                     grads[0][1])
+                    for grads in zip(*tower_grads) if grads[0][0] is not None]
+
+        d_optim = d_optimizer.apply_gradients(average(d_grads))
+        g_optim = g_optimizer.apply_gradients(average(g_grads))
+        return d_optim, g_optim, tf.reduce_mean(d_losses_real), \
+            tf.reduce_mean(d_losses_fake), tf.reduce_mean(g_losses)
+
+    @staticmethod
+    def summary_due(every, counter):
+        return every > 0 and counter % every == 0
+
+    def summaries(self, network, counter, config):
+        """Merged summaries of `network` ('d' or 'g') to fetch at `counter`.
+
+        Groups that are not due are left out of the fetches, so their ops
+        (the z histogram, the image encoding) do not run at all.
+        """
+        sums = []
+        for every, group in [(config.summary_scalars, self.scalar_sums),
+                             (config.summary_histograms, self.histogram_sums),
+                             (config.summary_images, self.image_sums)]:
+            if network in group and self.summary_due(every, counter):
+                sums.append(group[network])
+        return sums
+
+    def add_summaries(self, summary_strs, counter):
+        for summary_str in summary_strs:
+            self.writer.add_summary(summary_str, counter)
+
+    def complete(self, zhats, batch_images, batch_mask):
+        """Fill the masked out pixels of `batch_images` from G(zhats)"""
+        G_imgs = self.sess.run(self.G, feed_dict={self.z: zhats})
+        return np.multiply(batch_images, batch_mask) + \
+            np.multiply(G_imgs, 1.0 - batch_mask)
+
+    def inpaint_batch(self, config, zhats, batch_images, batch_mask,
+                      plateau, snapshot):
+        """Optimize `zhats` with Nesterov momentum, one sess.run per iteration"""
+        v = np.zeros_like(zhats)
+
+        # Best contextual loss (and its z) seen by every slot
+        best_loss = np.full(len(zhats), np.inf)
+        best_zhats = np.copy(zhats)
+        frozen = np.zeros(len(zhats), dtype=bool)
+
+        for i in xrange(config.nIter):
+            fd = {
+                self.z: zhats,
+                self.mask: batch_mask,
+                self.inputs: batch_images,
+            }
+            run = [self.complete_loss, self.contextual_loss,
+                   self.grad_complete_loss, self.G]
+            loss, ctx_loss, g, G_imgs = self.sess.run(run, feed_dict=fd)
+
+            improved = ctx_loss < best_loss
+            best_loss[improved] = ctx_loss[improved]
+            best_zhats[improved] = zhats[improved]
+
+            v_prev = np.copy(v)
+            v = config.momentum * v - config.lr * g[0]
+            v[frozen] = 0.0
+            step = -config.momentum * v_prev + (1 + config.momentum) * v
+            step[frozen] = 0.0
+            zhats = np.clip(zhats + step, -1, 1)
+
+            if snapshot is not None and i % 50 == 0:
+                snapshot.save(i, loss, ctx_loss, G_imgs)
+
+            if plateau.update(i, best_loss):
+                break
+            frozen = plateau.frozen_slots()
+
+        return best_loss, best_zhats
+
+    def inpaint_losses(self, z, images, mask, dtype=tf.float32):
+        """G(z) and the contextual, perceptual and complete losses of a new
+        copy of the generator and discriminator.
+
+        With a reduced precision `dtype` both networks run in it on cast
+        copies of the float32 weights, G and the losses are float32.
+        """
+        y = self.y if self.y_dim else None
+        if dtype != tf.float32:
+            z = tf.cast(z, dtype)
+            y = tf.cast(y, dtype) if self.y_dim else None
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            G = self.generator(z, y)
+            _, D_logits_ = self.discriminator(G, y, reuse=True)
+        G = tf.cast(G, tf.float32)
+        D_logits_ = tf.cast(D_logits_, tf.float32)
+
+        contextual_loss = tf.reduce_sum(
+            tf.contrib.layers.flatten(
+                tf.abs(tf.multiply(mask, G) - tf.multiply(mask, images))), 1)
+        perceptual_loss = tf.reduce_mean(
+            sigmoid_cross_entropy_with_logits(D_logits_, tf.ones_like(D_logits_)))
+        complete_loss = contextual_loss + self.lambda_val * perceptual_loss
+        return G, contextual_loss, perceptual_loss, complete_loss
+
+    def build_inference(self, dtype):
+        """Switch the sampler and the inpainting graph to `dtype`.
+
+        'float16' or 'bfloat16' weights and activations, float32 losses.
+        The float32 tensors are kept in `self.float32` for `check_inference`.
+        Call before `build_inpaint_loop`.
+        """
+        dtype = tf.as_dtype(dtype)
+        self.float32 = {
+            'sampler': self.sampler,
+            'G': self.G,
+            'contextual_loss': self.contextual_loss,
+            'grad_complete_loss': self.grad_complete_loss,
+        }
+        self.inference_dtype = dtype
+
+        y = tf.cast(self.y, dtype) if self.y_dim else None
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            self.sampler = tf.cast(
+                DCGAN.sampler(self, tf.cast(self.z, dtype), y), tf.float32)
+        self.G, self.contextual_loss, self.perceptual_loss, \
+            self.complete_loss = self.inpaint_losses(
+                self.z, self.inputs, self.mask, dtype)
+        self.grad_complete_loss = tf.gradients(self.complete_loss, self.z)
+
+    def check_inference(self, n=64, seed=0):
+        """Largest and mean absolute difference of the reduced precision
+        sampler, G, contextual loss and its gradient to float32, for `n`
+        seeded random z, images and center masks"""
+        rng = np.random.RandomState(seed)
+        zhats = rng.uniform(-1, 1, size=(n, self.z_dim))
+        batch_images = rng.uniform(-1, 1, size=[n] + self.image_shape)
+        batch_mask = make_masks('center', n, self.image_shape)
+        fd = {self.z: zhats, self.inputs: batch_images, self.mask: batch_mask}
+        if self.y_dim:
+            fd[self.y] = np.eye(self.y_dim)[
+                rng.randint(self.y_dim, size=len(zhats))]
+
+        # The samplers first, the training mode G runs update the moving
+        # averages they read
+        names = ['sampler', 'G', 'contextual_loss', 'grad_complete_loss']
+        reduced = [self.sess.run(self.sampler, feed_dict=fd)]
+        exact = [self.sess.run(self.float32['sampler'], feed_dict=fd)]
+        reduced += self.sess.run([self.G, self.contextual_loss,
+                                  self.grad_complete_loss[0]], feed_dict=fd)
+        exact += self.sess.run([self.float32['G'],
+                                self.float32['contextual_loss'],
+                                self.float32['grad_complete_loss'][0]],
+                               feed_dict=fd)
+        errors = {}
+        for name, a, b in zip(names, reduced, exact):
+            diff = np.abs(a.astype(np.float64) - b)
+            errors[name] = (float(diff.max()), float(diff.mean()))
+            print(" [*] {} vs float32 {}: max abs err {:.5f}, mean {:.6f}".format(
+                self.inference_dtype.name, name, *errors[name]))
+        return errors
+
+    def export_sampler(self, path):
+        """Write the sampler as a standalone frozen graph, see frozen.py.
+
+        Every batch norm (with its moving averages, as in `sampler`) is
+        folded into the weights and biases of the layer before it, so the
+        exported graph is one matmul and four transposed convolutions.
+        """
+        from frozen import FrozenSampler, Z_NAME, OUTPUT_NAME
 
-            save_images_inpaint(masked_images[:batchSz, :, :, :], [nRows, nCols],
-                                os.path.join(config.outDir, 'masked.png'))
-
-            for i in xrange(config.nIter):
-                fd = {
-                    self.z: zhats,
-                    self.mask: batch_mask,
-                    self.inputs: batch_images,
-                }
-                run = [self.complete_loss, self.grad_complete_loss, self.G]
-                loss, g, G_imgs = self.sess.run(run, feed_dict=fd)
-
-                v_prev = np.copy(v)
-                v = config.momentum * v - config.lr * g[0]
-                zhats += -config.momentum * v_prev + (1 + config.momentum) * v
-                zhats = np.clip(zhats, -1, 1)
-
-                if i % 50 == 0:
-                    inpaint_loss = np.mean(loss[0:batchSz])
-                    print('Inpainting Epoch: {}           Inpainting Loss: {}'.format(
-                        i, inpaint_loss))
-                    to_file_inpaint.append({i: inpaint_loss})
-
-                    imgName = os.path.join(config.outDir,
-                                           'hats_imgs/{:04d}.png'.format(i))
-                    nRows = np.ceil(batchSz / 8)
-                    nCols = 8
-                    save_images_inpaint(G_imgs[:batchSz, :, :, :],
-                                        [nRows, nCols], imgName)
-
-                    inv_masked_hat_images = np.multiply(
-                        G_imgs, 1.0 - batch_mask)
-                    completeed = masked_images + inv_masked_hat_images
-                    imgName = os.path.join(config.outDir,
-                                           'inpainted/{:04d}.png'.format(i))
-                    save_images_inpaint(completeed[:batchSz, :, :, :], [
-                        nRows, nCols], imgName)
-        with open(os.path.join(config.outDir, 'Inpaint_Results.txt'), 'wb') as f:
-            for data_item in to_file_inpaint:
-                f.write(str(data_item) + '\n'.encode())
+        if self.y_dim:
+            raise ValueError('Only the unconditional sampler can be exported')
+        variables = dict((v.op.name, v) for v in tf.global_variables()
+                         if v.op.name.startswith('generator/'))
+        values = self.sess.run(variables)
+
+        def fold(layer, bn, w_name, b_name, repeat=1):
+            w = values['generator/{}/{}'.format(layer, w_name)]
+            b = values['generator/{}/{}'.format(layer, b_name)]
+            if bn is None:
+                return w, b
+            stats = 'generator/{}/'.format(bn.name)
+            scale = values[stats + 'gamma'] / \
+                np.sqrt(values[stats + 'moving_variance'] + bn.epsilon)
+            shift = values[stats + 'beta'] - values[stats + 'moving_mean'] * scale
+            # The channels of a projection are the fastest varying axis
+            scale, shift = np.tile(scale, repeat), np.tile(shift, repeat)
+            if w.ndim == 2:
+                w = w * scale[None, :]
+            else:
+                # conv2d_transpose filters are [h, w, out, in]
+                w = w * scale[None, None, :, None]
+            return w, b * scale + shift
+
+        s_h, s_w = self.output_height, self.output_width
+        sizes = [(s_h, s_w)]
+        for _ in xrange(4):
+            sizes.insert(0, (conv_out_size_same(sizes[0][0], 2),
+                             conv_out_size_same(sizes[0][1], 2)))
+        channels = [self.gf_dim * 8, self.gf_dim * 4, self.gf_dim * 2,
+                    self.gf_dim * 1, self.c_dim]
+
+        graph = tf.Graph()
+        with graph.as_default():
+            z = tf.placeholder(tf.float32, [None, self.z_dim], name=Z_NAME)
+            batch_size = tf.shape(z)[0]
+
+            w, b = fold('g_h0_lin', self.g_bn0, 'Matrix', 'bias',
+                        repeat=sizes[0][0] * sizes[0][1])
+            h = tf.nn.relu(tf.matmul(z, w) + b)
+            h = tf.reshape(h, [-1, sizes[0][0], sizes[0][1], channels[0]])
+
+            bns = [self.g_bn1, self.g_bn2, self.g_bn3, None]
+            for i, bn in enumerate(bns):
+                w, b = fold('g_h{}'.format(i + 1), bn, 'w', 'biases')
+                h = tf.nn.conv2d_transpose(
+                    h, w, tf.stack([batch_size, sizes[i + 1][0],
+                                    sizes[i + 1][1], channels[i + 1]]),
+                    strides=[1, 2, 2, 1])
+                h = tf.nn.bias_add(h, b)
+                if bn is not None:
+                    h = tf.nn.relu(h)
+            tf.nn.tanh(h, name=OUTPUT_NAME)
+
+        with open(path, 'wb') as f:
+            f.write(graph.as_graph_def().SerializeToString())
+
+        # Compare with the sampler of the training graph
+        z = np.random.RandomState(0).uniform(
+            -1, 1, size=(self.sample_num, self.z_dim))
+        sampler = getattr(self, 'float32', {}).get('sampler', self.sampler)
+        expected = self.sess.run(sampler, feed_dict={self.z: z})
+        frozen = FrozenSampler(path)
+        error = np.abs(frozen.sample(z) - expected).max()
+        frozen.close()
+        print(" [*] Exported the sampler to {} ({:.1f} MB), max abs err {:.6f}".format(
+            path, os.path.getsize(path) / 2.0 ** 20, error))
+
+    def inference_variables(self, generator_only=False):
+        scopes = ('generator/',) if generator_only else \
+            ('generator/', 'discriminator/')
+        return [v for v in tf.global_variables()
+                if v.op.name.startswith(scopes)]
+
+    def export_weights(self, path, step=0, generator_only=False):
+        """Write the weights inference needs to a flat file, see weights.py.
+
+        The generator and discriminator variables with their batch norm
+        statistics, without optimizer slots. Inpainting needs both
+        networks (the perceptual loss runs D), sampling only G.
+        """
+        from weights import save_weights
+
+        variables = self.inference_variables(generator_only)
+        values = self.sess.run(variables)
+        save_weights(path, [(v.op.name, value)
+                            for v, value in zip(variables, values)], {
+            'step': step,
+            'generator_only': generator_only,
+            'z_dim': self.z_dim,
+            'y_dim': self.y_dim or 0,
+            'output_height': self.output_height,
+            'output_width': self.output_width,
+            'c_dim': self.c_dim,
+        })
+        print(" [*] Exported {} weights to {} ({:.1f} MB)".format(
+            'generator' if generator_only else 'inference', path,
+            os.path.getsize(path) / 2.0 ** 20))
+
+    def load_weights(self, path, generator_only=False):
+        """Assign the variables from a file written by `export_weights`.
+
+        Returns (True, step) like `load`, without touching the optimizer
+        or any variable outside the two networks.
+        """
+        from weights import WeightFile
+
+        print(" [***] Reading weights {}".format(path))
+        weights = WeightFile(path)
+        variables = self.inference_variables(generator_only)
+        missing = [v.op.name for v in variables if v.op.name not in weights]
+        if missing:
+            raise ValueError('{} has no {}{}'.format(
+                path, ', '.join(missing[:3]),
+                ' (exported with generator_only?)'
+                if missing[0].startswith('discriminator/') else ''))
+        for v in variables:
+            value = weights[v.op.name]
+            if tuple(value.shape) != tuple(v.get_shape().as_list()):
+                raise ValueError('{} is {} in {}, the model has {}'.format(
+                    v.op.name, value.shape, path, v.get_shape()))
+            v.load(value, self.sess)
+        step = int(weights.metadata.get('step', 0))
+        print(" [***] Success to read {} variables of step {}".format(
+            len(variables), step))
+        return True, step
+
+    def restore(self, checkpoint_dir, weights='', generator_only=False,
+                verify=False):
+        # A flat weight file if one is given, the checkpoint otherwise
+        if weights:
+            return self.load_weights(weights, generator_only)
+        return self.load(checkpoint_dir, verify=verify)
+
+    def build_inpaint_loop(self, lr, momentum):
+        """Build the in-graph version of the `inpaint_batch` update.
+
+        z, its velocity and the best z per slot live in variables, and
+        `loop_steps` iterations run inside one tf.while_loop, so nothing is
+        copied between TensorFlow and NumPy until a snapshot is written.
+        """
+        def loop_variable(name, shape):
+            # validate_shape=False lets every batch assign its own size
+            var = tf.get_variable(name, initializer=tf.zeros([0] + shape),
+                                  trainable=False, validate_shape=False)
+            value = tf.identity(var)
+            value.set_shape([None] + shape)
+            return var, value
+
+        with tf.variable_scope("inpaint_loop"):
+            self.loop_z, loop_z = loop_variable('z', [self.z_dim])
+            self.loop_v, loop_v = loop_variable('v', [self.z_dim])
+            self.loop_best_z, loop_best_z = loop_variable(
+                'best_z', [self.z_dim])
+            self.loop_best_loss, loop_best_loss = loop_variable(
+                'best_loss', [])
+            self.loop_images, loop_images = loop_variable(
+                'images', self.image_shape)
+            self.loop_mask, loop_mask = loop_variable(
+                'mask', self.image_shape)
+
+        # Loaded once per batch
+        self.loop_z_in = tf.placeholder(
+            tf.float32, [None, self.z_dim], name='loop_z_in')
+        self.loop_init = tf.group(
+            tf.assign(self.loop_z, self.loop_z_in, validate_shape=False),
+            tf.assign(self.loop_v, tf.zeros_like(self.loop_z_in),
+                      validate_shape=False),
+            tf.assign(self.loop_best_z, self.loop_z_in, validate_shape=False),
+            tf.assign(self.loop_best_loss,
+                      tf.fill(tf.shape(self.loop_z_in)[:1], np.inf),
+                      validate_shape=False),
+            tf.assign(self.loop_images, self.inputs, validate_shape=False),
+            tf.assign(self.loop_mask, self.mask, validate_shape=False))
+
+        # Fed on every run: iteration count and 1.0 for slots still updated
+        self.loop_steps = tf.placeholder(tf.int32, [], name='loop_steps')
+        self.loop_active = tf.placeholder(
+            tf.float32, [None], name='loop_active')
+
+        def losses(z):
+            G, contextual_loss, _, complete_loss = self.inpaint_losses(
+                z, loop_images, loop_mask, self.inference_dtype)
+            return G, contextual_loss, complete_loss
+
+        active = tf.expand_dims(self.loop_active, 1)
+
+        # z as the run starts, fetched together with loop_run for snapshots
+        self.loop_G, self.loop_contextual_loss, self.loop_complete_loss = \
+            losses(loop_z)
+
+        def body(i, z, v, best_z, best_loss):
+            _, contextual_loss, complete_loss = losses(z)
+            g = tf.gradients(complete_loss, z)[0]
+
+            improved = contextual_loss < best_loss
+            best_loss = tf.where(improved, contextual_loss, best_loss)
+            best_z = tf.where(improved, z, best_z)
+
+            v_new = (momentum * v - lr * g) * active
+            step = (-momentum * v + (1 + momentum) * v_new) * active
+            z = tf.clip_by_value(z + step, -1, 1)
+            return i + 1, z, v_new, best_z, best_loss
+
+        _, z, v, best_z, best_loss = tf.while_loop(
+            lambda i, *_: i < self.loop_steps, body,
+            [tf.constant(0), loop_z, loop_v, loop_best_z, loop_best_loss],
+            back_prop=False)
+
+        # The variables are only overwritten once the start losses are done
+        with tf.control_dependencies([z, v, best_z, best_loss,
+                                      self.loop_G, self.loop_contextual_loss,
+                                      self.loop_complete_loss]):
+            self.loop_run = tf.group(
+                tf.assign(self.loop_z, z, validate_shape=False),
+                tf.assign(self.loop_v, v, validate_shape=False),
+                tf.assign(self.loop_best_z, best_z, validate_shape=False),
+                tf.assign(self.loop_best_loss, best_loss, validate_shape=False))
+        self.loop_next_best_loss = best_loss
+
+    def inpaint_batch_in_graph(self, config, zhats, batch_images, batch_mask,
+                               plateau, snapshot):
+        """Same update as `inpaint_batch`, 50 iterations per sess.run.
+
+        Every run also returns the best losses and the snapshot losses, G
+        is only fetched when the snapshot writes grids.
+        """
+        self.sess.run(self.loop_init, feed_dict={
+            self.loop_z_in: zhats,
+            self.inputs: batch_images,
+            self.mask: batch_mask,
+        })
+
+        active = np.ones(len(zhats), dtype=np.float32)
+
+        fetches = [self.loop_run, self.loop_next_best_loss]
+        if snapshot is not None:
+            fetches += [self.loop_complete_loss, self.loop_contextual_loss]
+            if getattr(snapshot, 'grids', True):
+                fetches.append(self.loop_G)
+
+        for i in xrange(0, config.nIter, 50):
+            steps = min(50, config.nIter - i)
+            results = self.sess.run(fetches, feed_dict={
+                self.loop_steps: steps,
+                self.loop_active: active,
+            })
+            best_loss = results[1]
+            if snapshot is not None:
+                G_imgs = results[4] if len(results) > 4 else None
+                snapshot.save(i, results[2], results[3], G_imgs)
+
+            if plateau.update(i + steps - 1, best_loss):
+                break
+            active = (~plateau.frozen_slots()).astype(np.float32)
+
+        return self.sess.run([self.loop_best_loss, self.loop_best_z])
+
+    def pack(self, cache_file, datasets, dtype='float32'):
+        """Decode `datasets` once into a memory-mapped cache for train/inpaint"""
+        from cache import pack_images
+        pack_images(cache_file, datasets,
+                    self.input_height, self.input_width,
+                    resize_height=self.output_height,
+                    resize_width=self.output_width,
+                    is_crop=self.is_crop,
+                    is_grayscale=self.is_grayscale,
+                    dtype=dtype)
 
     def discriminator(self, image, y=None, reuse=False):
         with tf.variable_scope("discriminator") as scope:
@@ -595,11 +1440,11 @@ class DCGAN(object):
                 h3 = lrelu(self.d_bn3(
                     conv2d(h2, self.df_dim * 8, name='d_h3_conv')))
                 h4 = linear(tf.reshape(
-                    h3, [self.batch_size, -1]), 1, 'd_h3_lin')
+                    h3, [-1, h3.get_shape()[1:].num_elements()]), 1, 'd_h3_lin')
 
                 return tf.nn.sigmoid(h4), h4
             else:
-                yb = tf.reshape(y, [self.batch_size, 1, 1, self.y_dim])
+                yb = tf.reshape(y, [-1, 1, 1, self.y_dim])
                 x = conv_cond_concat(image, yb)
 
                 h0 = lrelu(
@@ -608,7 +1453,7 @@ class DCGAN(object):
 
                 h1 = lrelu(self.d_bn1(
                     conv2d(h0, self.df_dim + self.y_dim, name='d_h1_conv')))
-                h1 = tf.reshape(h1, [self.batch_size, -1])
+                h1 = tf.reshape(h1, [-1, h1.get_shape()[1:].num_elements()])
                 h1 = concat([h1, y], 1)
 
                 h2 = lrelu(self.d_bn2(linear(h1, self.dfc_dim, 'd_h2_lin')))
@@ -620,6 +1465,9 @@ class DCGAN(object):
 
     def generator(self, z, y=None):
         with tf.variable_scope("generator") as scope:
+            # Batch dimension of the deconv outputs follows z
+            batch_size = tf.shape(z)[0]
+
             if not self.y_dim:
                 s_h, s_w = self.output_height, self.output_width
                 s_h2, s_w2 = conv_out_size_same(
@@ -640,19 +1488,19 @@ class DCGAN(object):
                 h0 = tf.nn.relu(self.g_bn0(self.h0))
 
                 self.h1, self.h1_w, self.h1_b = deconv2d(
-                    h0, [self.batch_size, s_h8, s_w8, self.gf_dim * 4], name='g_h1', with_w=True)
+                    h0, [batch_size, s_h8, s_w8, self.gf_dim * 4], name='g_h1', with_w=True)
                 h1 = tf.nn.relu(self.g_bn1(self.h1))
 
                 h2, self.h2_w, self.h2_b = deconv2d(
-                    h1, [self.batch_size, s_h4, s_w4, self.gf_dim * 2], name='g_h2', with_w=True)
+                    h1, [batch_size, s_h4, s_w4, self.gf_dim * 2], name='g_h2', with_w=True)
                 h2 = tf.nn.relu(self.g_bn2(h2))
 
                 h3, self.h3_w, self.h3_b = deconv2d(
-                    h2, [self.batch_size, s_h2, s_w2, self.gf_dim * 1], name='g_h3', with_w=True)
+                    h2, [batch_size, s_h2, s_w2, self.gf_dim * 1], name='g_h3', with_w=True)
                 h3 = tf.nn.relu(self.g_bn3(h3))
 
                 h4, self.h4_w, self.h4_b = deconv2d(
-                    h3, [self.batch_size, s_h, s_w, self.c_dim], name='g_h4', with_w=True)
+                    h3, [batch_size, s_h, s_w, self.c_dim], name='g_h4', with_w=True)
 
                 return tf.nn.tanh(h4)
             else:
@@ -661,7 +1509,7 @@ class DCGAN(object):
                 s_w2, s_w4 = int(s_w / 2), int(s_w / 4)
 
                 # yb = tf.expand_dims(tf.expand_dims(y, 1),2)
-                yb = tf.reshape(y, [self.batch_size, 1, 1, self.y_dim])
+                yb = tf.reshape(y, [-1, 1, 1, self.y_dim])
                 z = concat([z, y], 1)
 
                 h0 = tf.nn.relu(
@@ -671,21 +1519,24 @@ class DCGAN(object):
                 h1 = tf.nn.relu(self.g_bn1(
                     linear(h0, self.gf_dim * 2 * s_h4 * s_w4, 'g_h1_lin')))
                 h1 = tf.reshape(
-                    h1, [self.batch_size, s_h4, s_w4, self.gf_dim * 2])
+                    h1, [-1, s_h4, s_w4, self.gf_dim * 2])
 
                 h1 = conv_cond_concat(h1, yb)
 
                 h2 = tf.nn.relu(self.g_bn2(deconv2d(h1,
-                                                    [self.batch_size, s_h2, s_w2, self.gf_dim * 2], name='g_h2')))
+                                                    [batch_size, s_h2, s_w2, self.gf_dim * 2], name='g_h2')))
                 h2 = conv_cond_concat(h2, yb)
 
                 return tf.nn.sigmoid(
-                    deconv2d(h2, [self.batch_size, s_h, s_w, self.c_dim], name='g_h3'))
+                    deconv2d(h2, [batch_size, s_h, s_w, self.c_dim], name='g_h3'))
 
     def sampler(self, z, y=None):
         with tf.variable_scope("generator") as scope:
             scope.reuse_variables()
 
+            # Batch dimension of the deconv outputs follows z
+            batch_size = tf.shape(z)[0]
+
             if not self.y_dim:
                 s_h, s_w = self.output_height, self.output_width
                 s_h2, s_w2 = conv_out_size_same(
@@ -703,19 +1554,19 @@ class DCGAN(object):
                     [-1, s_h16, s_w16, self.gf_dim * 8])
                 h0 = tf.nn.relu(self.g_bn0(h0, train=False))
 
-                h1 = deconv2d(h0, [self.batch_size, s_h8,
+                h1 = deconv2d(h0, [batch_size, s_h8,
                                    s_w8, self.gf_dim * 4], name='g_h1')
                 h1 = tf.nn.relu(self.g_bn1(h1, train=False))
 
-                h2 = deconv2d(h1, [self.batch_size, s_h4,
+                h2 = deconv2d(h1, [batch_size, s_h4,
                                    s_w4, self.gf_dim * 2], name='g_h2')
                 h2 = tf.nn.relu(self.g_bn2(h2, train=False))
 
-                h3 = deconv2d(h2, [self.batch_size, s_h2,
+                h3 = deconv2d(h2, [batch_size, s_h2,
                                    s_w2, self.gf_dim * 1], name='g_h3')
                 h3 = tf.nn.relu(self.g_bn3(h3, train=False))
 
-                h4 = deconv2d(h3, [self.batch_size, s_h,
+                h4 = deconv2d(h3, [batch_size, s_h,
                                    s_w, self.c_dim], name='g_h4')
 
                 return tf.nn.tanh(h4)
@@ -725,7 +1576,7 @@ class DCGAN(object):
                 s_w2, s_w4 = int(s_w / 2), int(s_w / 4)
 
                 # yb = tf.reshape(y, [-1, 1, 1, self.y_dim])
-                yb = tf.reshape(y, [self.batch_size, 1, 1, self.y_dim])
+                yb = tf.reshape(y, [-1, 1, 1, self.y_dim])
                 z = concat([z, y], 1)
 
                 h0 = tf.nn.relu(self.g_bn0(
@@ -735,51 +1586,19 @@ class DCGAN(object):
                 h1 = tf.nn.relu(self.g_bn1(
                     linear(h0, self.gf_dim * 2 * s_h4 * s_w4, 'g_h1_lin'), train=False))
                 h1 = tf.reshape(
-                    h1, [self.batch_size, s_h4, s_w4, self.gf_dim * 2])
+                    h1, [-1, s_h4, s_w4, self.gf_dim * 2])
                 h1 = conv_cond_concat(h1, yb)
 
                 h2 = tf.nn.relu(self.g_bn2(
-                    deconv2d(h1, [self.batch_size, s_h2, s_w2, self.gf_dim * 2], name='g_h2'), train=False))
+                    deconv2d(h1, [batch_size, s_h2, s_w2, self.gf_dim * 2], name='g_h2'), train=False))
                 h2 = conv_cond_concat(h2, yb)
 
-                return tf.nn.sigmoid(deconv2d(h2, [self.batch_size, s_h, s_w, self.c_dim], name='g_h3'))
+                return tf.nn.sigmoid(deconv2d(h2, [batch_size, s_h, s_w, self.c_dim], name='g_h3'))
 
     def load_mnist(self):
-        data_dir = os.path.join("./data", self.dataset_name)
-
-        fd = open(os.path.join(data_dir, 'train-images-idx3-ubyte'))
-        loaded = np.fromfile(file=fd, dtype=np.uint8)
-        trX = loaded[16:].reshape((60000, 28, 28, 1)).astype(np.float)
-
-        fd = open(os.path.join(data_dir, 'train-labels-idx1-ubyte'))
-        loaded = np.fromfile(file=fd, dtype=np.uint8)
-        trY = loaded[8:].reshape((60000)).astype(np.float)
-
-        fd = open(os.path.join(data_dir, 't10k-images-idx3-ubyte'))
-        loaded = np.fromfile(file=fd, dtype=np.uint8)
-        teX = loaded[16:].reshape((10000, 28, 28, 1)).astype(np.float)
-
-        fd = open(os.path.join(data_dir, 't10k-labels-idx1-ubyte'))
-        loaded = np.fromfile(file=fd, dtype=np.uint8)
-        teY = loaded[8:].reshape((10000)).astype(np.float)
-
-        trY = np.asarray(trY)
-        teY = np.asarray(teY)
-
-        X = np.concatenate((trX, teX), axis=0)
-        y = np.concatenate((trY, teY), axis=0).astype(np.int)
-
-        seed = 547
-        np.random.seed(seed)
-        np.random.shuffle(X)
-        np.random.seed(seed)
-        np.random.shuffle(y)
-
-        y_vec = np.zeros((len(y), self.y_dim), dtype=np.float)
-        for i, label in enumerate(y):
-            y_vec[i, y[i]] = 1.0
-
-        return X / 255., y_vec
+        # uint8 images and labels, normalized batch by batch
+        from mnist import MnistData
+        return MnistData(os.path.join("./data", self.dataset_name), self.y_dim)
 
     @property
     def model_dir(self):
@@ -787,20 +1606,65 @@ class DCGAN(object):
             self.dataset_name, self.batch_size,
             self.output_height, self.output_width)
 
-    def save(self, checkpoint_dir, step):
+    def hparams(self, config=None):
+        # Recorded in the checkpoint manifest
+        hparams = {
+            'dataset': self.dataset_name,
+            'dataset2': self.dataset_name2,
+            'batch_size': self.batch_size,
+            'input_height': self.input_height,
+            'input_width': self.input_width,
+            'is_crop': bool(self.is_crop),
+            'lambda_val': self.lambda_val,
+        }
+        if config is not None:
+            for name in ['learning_rate', 'beta1', 'z_source', 'num_towers']:
+                hparams[name] = getattr(config, name)
+        return hparams
+
+    def save(self, checkpoint_dir, step, metric=None):
         model_name = "DCGAN.model"
+        manifest = Manifest(checkpoint_dir)
         checkpoint_dir = os.path.join(checkpoint_dir, self.model_dir)
 
         if not os.path.exists(checkpoint_dir):
             os.makedirs(checkpoint_dir)
 
-        self.saver.save(self.sess,
-                        os.path.join(checkpoint_dir, model_name),
-                        global_step=step)
-
-    def load(self, checkpoint_dir):
+        if getattr(self, 'checkpoint_writer', None) is not None:
+            self.checkpoint_writer.save(
+                os.path.join(checkpoint_dir, model_name), step, metric)
+            return
+        path = self.saver.save(self.sess,
+                               os.path.join(checkpoint_dir, model_name),
+                               global_step=step)
+        manifest.add(path, step, self.architecture, self.hparams(),
+                     self.variable_shapes())
+
+    def variable_shapes(self):
+        # Of the variables a checkpoint holds, the model and batch norm state
+        return dict((v.op.name, v.get_shape().as_list())
+                    for v in self.inference_variables())
+
+    def load(self, checkpoint_dir, same_dataset=False, verify=False):
         import re
         print(" [***] Reading checkpoints...")
+
+        # The newest compatible checkpoint of the manifest, wherever it is.
+        # Training resumes only from its own dataset. `verify` also hashes
+        # all of its data before restoring it
+        manifest = Manifest(checkpoint_dir, verify=verify)
+        shapes = self.variable_shapes()
+        for entry in manifest.candidates(self.architecture, self.dataset_name,
+                                         same_dataset):
+            problem = manifest.check(entry, shapes)
+            if problem is not None:
+                print(" [!] Skipping {}: {}".format(entry['path'], problem))
+                continue
+            self.saver.restore(self.sess, manifest.prefix(entry))
+            print(" [***] Success to read {}".format(entry['path']))
+            return True, entry['step']
+
+        # Checkpoints saved before the manifest
         checkpoint_dir = os.path.join(checkpoint_dir, self.model_dir)
 
         ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
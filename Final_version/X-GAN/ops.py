@@ -28,6 +28,20 @@ else:
         return tf.concat(tensors, axis, *args, **kwargs)
 
 
+def cast_like(var, x):
+    # Variables stay float32, reduced precision layers read a cast copy
+    if var.dtype.base_dtype != x.dtype.base_dtype:
+        return tf.cast(var, x.dtype.base_dtype)
+    return var
+
+
+def sigmoid_cross_entropy_with_logits(x, y):
+    try:
+        return tf.nn.sigmoid_cross_entropy_with_logits(logits=x, labels=y)
+    except:
+        return tf.nn.sigmoid_cross_entropy_with_logits(logits=x, targets=y)
+
+
 class batch_norm(object):
 
     def __init__(self, epsilon=1e-5, momentum=0.9, name="batch_norm"):
@@ -37,13 +51,21 @@ class batch_norm(object):
             self.name = name
 
     def __call__(self, x, train=True):
-        return tf.contrib.layers.batch_norm(x,
-                                            decay=self.momentum,
-                                            updates_collections=None,
-                                            epsilon=self.epsilon,
-                                            scale=True,
-                                            is_training=train,
-                                            scope=self.name)
+        # Normalized in float32 for reduced precision inputs, so statistics
+        # and moving averages keep their precision
+        dtype = x.dtype.base_dtype
+        if dtype != tf.float32:
+            x = tf.cast(x, tf.float32)
+        x = tf.contrib.layers.batch_norm(x,
+                                         decay=self.momentum,
+                                         updates_collections=None,
+                                         epsilon=self.epsilon,
+                                         scale=True,
+                                         is_training=train,
+                                         scope=self.name)
+        if dtype != tf.float32:
+            x = tf.cast(x, dtype)
+        return x
 
 
 def conv_cond_concat(x, y):
@@ -51,19 +73,19 @@ def conv_cond_concat(x, y):
     x_shapes = x.get_shape()
     y_shapes = y.get_shape()
     return concat([
-        x, y * tf.ones([x_shapes[0], x_shapes[1], x_shapes[2], y_shapes[3]])], 3)
+        x, y * tf.ones(tf.stack([tf.shape(x)[0], int(x_shapes[1]), int(x_shapes[2]), int(y_shapes[3])]))], 3)
 
 
 def conv2d(input_, output_dim, k_h=5, k_w=5, d_h=2, d_w=2, stddev=0.02, name="conv2d"):
     with tf.variable_scope(name):
         w = tf.get_variable('w', [k_h, k_w, input_.get_shape()[-1], output_dim],
                             initializer=tf.truncated_normal_initializer(stddev=stddev))
-        conv = tf.nn.conv2d(input_, w, strides=[
+        conv = tf.nn.conv2d(input_, cast_like(w, input_), strides=[
                             1, d_h, d_w, 1], padding='SAME')
 
         biases = tf.get_variable(
             'biases', [output_dim], initializer=tf.constant_initializer(0.0))
-        conv = tf.reshape(tf.nn.bias_add(conv, biases), conv.get_shape())
+        conv = tf.nn.bias_add(conv, cast_like(biases, input_))
 
         return conv
 
@@ -74,18 +96,21 @@ def deconv2d(input_, output_shape, k_h=5, k_w=5, d_h=2, d_w=2, stddev=0.02, name
         w = tf.get_variable('w', [k_h, k_w, output_shape[-1], input_.get_shape()[-1]],
                             initializer=tf.random_normal_initializer(stddev=stddev))
 
+        # The batch dimension of output_shape may be a tensor
         try:
-            deconv = tf.nn.conv2d_transpose(input_, w, output_shape=output_shape,
+            deconv = tf.nn.conv2d_transpose(input_, cast_like(w, input_), output_shape=tf.stack(output_shape),
                                             strides=[1, d_h, d_w, 1])
 
         # Support for verisons of TensorFlow before 0.7.0
         except AttributeError:
-            deconv = tf.nn.deconv2d(input_, w, output_shape=output_shape,
+            deconv = tf.nn.deconv2d(input_, cast_like(w, input_), output_shape=tf.stack(output_shape),
                                     strides=[1, d_h, d_w, 1])
 
         biases = tf.get_variable(
             'biases', [output_shape[-1]], initializer=tf.constant_initializer(0.0))
-        deconv = tf.reshape(tf.nn.bias_add(deconv, biases), deconv.get_shape())
+        deconv = tf.nn.bias_add(deconv, cast_like(biases, input_))
+        deconv.set_shape([output_shape[0] if isinstance(output_shape[0], int) else None] +
+                         list(output_shape[1:]))
 
         if with_w:
             return deconv, w, biases
@@ -105,7 +130,9 @@ def linear(input_, output_size, scope=None, stddev=0.02, bias_start=0.0, with_w=
                                  tf.random_normal_initializer(stddev=stddev))
         bias = tf.get_variable(
             "bias", [output_size], initializer=tf.constant_initializer(bias_start))
+        output = tf.matmul(input_, cast_like(matrix, input_)) + \
+            cast_like(bias, input_)
         if with_w:
-            return tf.matmul(input_, matrix) + bias, matrix, bias
+            return output, matrix, bias
         else:
-            return tf.matmul(input_, matrix) + bias
+            return output
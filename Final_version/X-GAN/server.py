@@ -0,0 +1,340 @@
+import os
+import json
+import time
+import base64
+import threading
+import numpy as np
+import tensorflow as tf
+from collections import deque
+from six.moves import queue
+from socketserver import ThreadingMixIn
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from model import DCGAN, model_architecture
+from checkpoints import Manifest
+from masks import make_masks
+from utils import decode_image, encode_png
+from convergence import PlateauTracker
+
+# Resident inpainting service
+# The graph is built and the checkpoint restored once, then concurrent
+# requests are packed into the fixed batch_size slots of one optimization
+#
+# POST /inpaint  {"images": [<base64 jpg/png>, ...], "mask": "center"}
+#                ("masks": [...] gives one mask spec per image instead,
+#                see masks.py for the specs)
+# GET  /stats    queue depth and latency of the served requests
+
+flags = tf.app.flags
+
+flags.DEFINE_string(flag_name="host", default_value="127.0.0.1",
+                    docstring="Address to listen on [127.0.0.1]")
+
+flags.DEFINE_integer(flag_name="port", default_value=8080,
+                     docstring="Port to listen on [8080]")
+
+flags.DEFINE_integer(flag_name="batch_size", default_value=64,
+                     docstring="Image slots per optimization batch [64]")
+
+flags.DEFINE_float(flag_name="batch_window", default_value=0.05,
+                   docstring="Seconds to wait for more requests before starting a batch [0.05]")
+
+flags.DEFINE_integer(flag_name="nIter", default_value=1000,
+                     docstring="Iterations per batch [1000]")
+
+flags.DEFINE_integer(flag_name="input_height", default_value=64,
+                     docstring="The size of image to use (will be center cropped). [64]")
+
+flags.DEFINE_integer(flag_name="input_width", default_value=None,
+                     docstring="The size of image to use (will be center cropped). If None, same value as input_height [None]")
+
+flags.DEFINE_float(flag_name="lr", default_value=0.01,
+                   docstring="Learning rate [0.01]")
+
+flags.DEFINE_float(flag_name="momentum", default_value=0.8,
+                   docstring="Momentum term of the z updates [0.8]")
+
+flags.DEFINE_integer(flag_name="plateau_iters", default_value=0,
+                     docstring="Stop an image after this many iterations without improvement, 0 to disable [0]")
+
+flags.DEFINE_float(flag_name="plateau_tol", default_value=1e-3,
+                   docstring="Relative contextual loss decrease that counts as an improvement [1e-3]")
+
+flags.DEFINE_boolean(flag_name="in_graph", default_value=False,
+                     docstring="True to run the z updates inside the graph, 50 iterations per session call [False]")
+
+flags.DEFINE_string(flag_name="precision", default_value="float32",
+                    docstring="Precision of the generator and discriminator while inpainting: {'float32', 'float16', 'bfloat16'}, losses stay float32 [float32]")
+
+flags.DEFINE_float(flag_name="gpu_utilization", default_value=0.8,
+                   docstring="Per process GPU memory fraction [0.8]")
+
+flags.DEFINE_float(flag_name="lambda_val", default_value=0.08,
+                   docstring="Lambda value for contextual and percptual loss [0.08]")
+
+flags.DEFINE_string(flag_name="checkpointDir", default_value="checkpoint",
+                    docstring="Directory name to load the checkpoints from [checkpoint]")
+
+flags.DEFINE_string(flag_name="weights", default_value="",
+                    docstring="Restore from this weight file (main.py --export_weights) instead of the checkpoint []")
+
+flags.DEFINE_integer(flag_name="c_dim", default_value=3,
+                     docstring="Dimension of image color/channels. [3]")
+
+flags.DEFINE_string(flag_name="dataset", default_value="celebA",
+                    docstring="The name of dataset feed to Discriminator [celebA, mnist, lsun]")
+
+flags.DEFINE_string(flag_name="dataset2", default_value="celebA",
+                    docstring="The name of dataset feed to Generator [celebA, mnist, lsun]")
+
+flags.DEFINE_boolean(flag_name="is_crop", default_value=False,
+                     docstring="True to center crop the posted images [False]")
+
+FLAGS = flags.FLAGS
+
+
+class InpaintJob(object):
+
+    def __init__(self, images, masks):
+        self.images = images
+        self.masks = masks
+        self.submitted = time.time()
+        self.started = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class InpaintService(object):
+    """Packs queued jobs into batches and runs them on one warm model"""
+
+    def __init__(self, dcgan, config):
+        self.dcgan = dcgan
+        self.config = config
+        self.queue = queue.Queue()
+        self.pending = None
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=1000)
+        self.served = 0
+        self.batches = 0
+        self.last_batch_fill = 0.0
+
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, images, masks):
+        if not images:
+            raise ValueError('No images in request')
+        if len(images) > self.dcgan.batch_size:
+            raise ValueError('At most {} images per request'.format(
+                self.dcgan.batch_size))
+        job = InpaintJob(images, masks)
+        self.queue.put(job)
+        return job
+
+    def next_batch(self):
+        # Block for the first job, then take whatever else fits into the
+        # batch within the batching window
+        job = self.pending or self.queue.get()
+        self.pending = None
+        jobs, slots = [job], len(job.images)
+        deadline = time.time() + self.config.batch_window
+        while slots < self.dcgan.batch_size:
+            try:
+                job = self.queue.get(
+                    timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if slots + len(job.images) > self.dcgan.batch_size:
+                self.pending = job
+                break
+            jobs.append(job)
+            slots += len(job.images)
+        return jobs, slots
+
+    def run(self):
+        while True:
+            jobs, slots = self.next_batch()
+            started = time.time()
+            for job in jobs:
+                job.started = started
+            try:
+                completed = self.inpaint(jobs, slots)
+            except Exception as e:
+                for job in jobs:
+                    job.error = str(e)
+                    job.done.set()
+                continue
+
+            l = 0
+            finished = time.time()
+            with self.lock:
+                for job in jobs:
+                    job.result = completed[l:l + len(job.images)]
+                    l += len(job.images)
+                    self.latencies.append(finished - job.submitted)
+                    self.served += 1
+                self.batches += 1
+                self.last_batch_fill = slots / float(self.dcgan.batch_size)
+            for job in jobs:
+                job.done.set()
+
+    def inpaint(self, jobs, slots):
+        dcgan = self.dcgan
+        shape = [slots] + dcgan.image_shape
+        batch_images = np.zeros(shape, dtype=np.float32)
+        batch_mask = np.ones(shape, dtype=np.float32)
+        l = 0
+        for job in jobs:
+            for image, mask in zip(job.images, job.masks):
+                batch_images[l] = image
+                batch_mask[l] = mask
+                l += 1
+
+        zhats = np.random.uniform(-1, 1, size=(slots, dcgan.z_dim))
+        plateau = PlateauTracker(slots, 1, self.config.plateau_iters,
+                                 self.config.plateau_tol)
+        if self.config.in_graph:
+            _, best_zhats = dcgan.inpaint_batch_in_graph(
+                self.config, zhats, batch_images, batch_mask, plateau, None)
+        else:
+            _, best_zhats = dcgan.inpaint_batch(
+                self.config, zhats, batch_images, batch_mask, plateau, None)
+        return dcgan.complete(best_zhats, batch_images, batch_mask)
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            stats = {
+                'queue_depth': self.queue.qsize() + (self.pending is not None),
+                'served': self.served,
+                'batches': self.batches,
+                'last_batch_fill': self.last_batch_fill,
+            }
+        if len(latencies):
+            stats['latency_avg'] = float(np.mean(latencies))
+            stats['latency_p50'] = float(np.percentile(latencies, 50))
+            stats['latency_p95'] = float(np.percentile(latencies, 95))
+        return stats
+
+
+class InpaintHandler(BaseHTTPRequestHandler):
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.send_json(404, {'error': 'Not found'})
+        self.send_json(200, self.server.service.stats())
+
+    def do_POST(self):
+        if self.path != '/inpaint':
+            return self.send_json(404, {'error': 'Not found'})
+        service = self.server.service
+        dcgan = service.dcgan
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            images = [decode_image(base64.b64decode(data),
+                                   dcgan.image_size, dcgan.image_size,
+                                   is_crop=dcgan.is_crop)
+                      for data in request['images']]
+            if 'masks' in request:
+                maskTypes = request['masks']
+                if len(maskTypes) != len(images):
+                    raise ValueError('Need one mask per image')
+            else:
+                maskTypes = request.get('mask', 'center')
+            masks = make_masks(maskTypes, len(images), dcgan.image_shape)
+            job = service.submit(images, masks)
+        except (KeyError, TypeError, ValueError, OSError) as e:
+            # OSError: PIL cannot identify the decoded bytes as an image
+            return self.send_json(400, {'error': str(e)})
+
+        job.done.wait()
+        if job.error is not None:
+            return self.send_json(500, {'error': job.error})
+        self.send_json(200, {
+            'images': [base64.b64encode(encode_png(image)).decode('ascii')
+                       for image in job.result],
+            'latency': time.time() - job.submitted,
+            'queue_wait': job.started - job.submitted,
+        })
+
+    def log_message(self, format, *args):
+        pass
+
+
+class InpaintHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def main(_):
+    assert(os.path.exists(FLAGS.checkpointDir))
+
+    # Deal with input size default values
+    if not FLAGS.input_width:
+        FLAGS.input_width = FLAGS.input_height
+
+    # Fail before building the graph if no saved checkpoint fits it
+    if not FLAGS.weights:
+        Manifest(FLAGS.checkpointDir).require(
+            model_architecture(c_dim=FLAGS.c_dim), FLAGS.dataset)
+
+    def get_default_gpu_session(fraction=0.8):
+        if fraction > 1:
+            fraction = 0.8
+        config = tf.ConfigProto(allow_soft_placement=True)
+        config.gpu_options.allow_growth = True
+        config.gpu_options.per_process_gpu_memory_fraction = fraction
+        return tf.Session(config=config)
+
+    with get_default_gpu_session(FLAGS.gpu_utilization) as sess:
+
+        dcgan_instance = DCGAN(
+            sess,
+            input_width=FLAGS.input_width,
+            input_height=FLAGS.input_height,
+            batch_size=FLAGS.batch_size,
+            c_dim=FLAGS.c_dim,
+            dataset_name=FLAGS.dataset,
+            is_crop=FLAGS.is_crop,
+            checkpoint_dir=FLAGS.checkpointDir,
+            lambda_val=FLAGS.lambda_val,
+            # Xx-GAN
+            dataset_name2=FLAGS.dataset2
+        )
+        if FLAGS.precision != 'float32':
+            dcgan_instance.build_inference(FLAGS.precision)
+        if FLAGS.in_graph:
+            dcgan_instance.build_inpaint_loop(FLAGS.lr, FLAGS.momentum)
+
+        tf.global_variables_initializer().run()
+        if not dcgan_instance.restore(FLAGS.checkpointDir, FLAGS.weights)[0]:
+            raise Exception(
+                "[!!!] Need to train a model first, then run the server")
+        if FLAGS.precision != 'float32':
+            dcgan_instance.check_inference(FLAGS.batch_size)
+
+        server = InpaintHTTPServer((FLAGS.host, FLAGS.port), InpaintHandler)
+        server.service = InpaintService(dcgan_instance, FLAGS)
+        print(" [*] Serving inpainting on http://{}:{}".format(
+            FLAGS.host, FLAGS.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+
+if __name__ == '__main__':
+    tf.app.run()
+    '''
+    python server.py --dataset test_cat_O --dataset2 test_cat_G --checkpointDir checkpoint --nIter 1000 --port 8080
+    '''
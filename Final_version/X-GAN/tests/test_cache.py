@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pytest
+
+import cache
+from cache import PackedDataset, pack_images
+
+SIZE = 4
+
+
+def fake_loader(*args, **kwargs):
+    # Image i is filled with the get_image value of pixel 10 * i
+    def load(path):
+        i = int(os.path.splitext(os.path.basename(path))[0])
+        return np.full((SIZE, SIZE, 3), 10 * i / 127.5 - 1.)
+    return load
+
+
+@pytest.fixture(params=['float32', 'uint8'])
+def packed(request, tmpdir, monkeypatch):
+    monkeypatch.setattr(cache, 'image_loader', fake_loader)
+    path = str(tmpdir.join('test.pack'))
+    pack_images(path, [('dataset', ['{}.jpg'.format(i) for i in range(5)]),
+                       ('dataset2', [])],
+                SIZE, SIZE, resize_height=SIZE, resize_width=SIZE,
+                dtype=request.param, chunk_size=2, num_workers=1)
+    return PackedDataset(path)
+
+
+def expected(indices):
+    return np.array([np.full((SIZE, SIZE, 3), 10 * i / 127.5 - 1.)
+                     for i in indices], dtype=np.float32)
+
+
+def test_take(packed):
+    assert len(packed) == 2
+    assert packed.size('dataset') == 5 and packed.size('dataset2') == 0
+    assert packed.files('dataset')[3] == '3.jpg'
+    batch = packed.take('dataset', [4, 0, 2])
+    assert batch.dtype == np.float32
+    np.testing.assert_allclose(batch, expected([4, 0, 2]), atol=1e-6)
+    flat = packed.take('dataset', [1], flatten=True)
+    assert flat.shape == (1, SIZE * SIZE * 3)
+
+
+def test_take_into_buffer(packed):
+    out = np.zeros((4, SIZE, SIZE, 3), dtype=np.float32)
+    batch = packed.take('dataset', [3, 1], out=out)
+    assert np.shares_memory(batch, out)
+    np.testing.assert_allclose(out[:2], expected([3, 1]), atol=1e-6)
+    assert not out[2:].any()
+    # The uint8 staging buffer is reused, not the batch of the first take
+    packed.take('dataset', [0, 4], out=out)
+    np.testing.assert_allclose(out[:2], expected([0, 4]), atol=1e-6)
+
+
+def test_check(packed):
+    packed.check(SIZE, SIZE, SIZE, SIZE, True, False)
+    with pytest.raises(ValueError):
+        packed.check(SIZE, SIZE, SIZE, SIZE, False, False)
+
+
+def test_not_a_pack(tmpdir):
+    path = tmpdir.join('other.pack')
+    path.write_binary(b'not a pack file')
+    with pytest.raises(ValueError):
+        PackedDataset(str(path))
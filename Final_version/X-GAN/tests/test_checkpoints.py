@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from model import DCGAN
+from checkpoints import CheckpointWriter, Manifest
+
+
+def small_dcgan(sess, checkpoint_dir, batch_size=4):
+    return DCGAN(sess, input_height=8, input_width=8, output_height=8,
+                 output_width=8, batch_size=batch_size, sample_num=batch_size,
+                 gf_dim=4, df_dim=4, gfc_dim=16, dfc_dim=16,
+                 dataset_name='tiny', checkpoint_dir=checkpoint_dir,
+                 summaries=False)
+
+
+def generator_values(dcgan):
+    return dcgan.sess.run(dcgan.inference_variables(generator_only=True))
+
+
+def test_save_load_round_trip(tmpdir):
+    checkpoint_dir = str(tmpdir)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        dcgan = small_dcgan(sess, checkpoint_dir, batch_size=4)
+        tf.global_variables_initializer().run()
+        dcgan.save(checkpoint_dir, 7)
+        saved = generator_values(dcgan)
+
+    # A different batch size used to mean a different model_dir
+    with tf.Graph().as_default(), tf.Session() as sess:
+        dcgan = small_dcgan(sess, checkpoint_dir, batch_size=2)
+        tf.global_variables_initializer().run()
+        assert dcgan.load(checkpoint_dir) == (True, 7)
+        for expected, value in zip(saved, generator_values(dcgan)):
+            np.testing.assert_array_equal(expected, value)
+
+
+def test_manifest_refuses_changed_checkpoint(tmpdir):
+    checkpoint_dir = str(tmpdir)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        dcgan = small_dcgan(sess, checkpoint_dir)
+        tf.global_variables_initializer().run()
+        dcgan.save(checkpoint_dir, 1)
+        manifest = Manifest(checkpoint_dir)
+        entry = manifest.find(dcgan.architecture, 'tiny')
+        assert manifest.check(entry, dcgan.variable_shapes()) is None
+
+        for index in tmpdir.visit('*.index'):
+            index.write_binary(index.read_binary() + b'x')
+        assert 'changed' in manifest.check(entry, dcgan.variable_shapes())
+
+
+def test_verify_checks_all_data(tmpdir):
+    checkpoint_dir = str(tmpdir)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        dcgan = small_dcgan(sess, checkpoint_dir)
+        tf.global_variables_initializer().run()
+        manifest = Manifest(checkpoint_dir, verify=True)
+        writer = CheckpointWriter(sess, dcgan.saved_variables,
+                                  background=False, manifest=manifest,
+                                  architecture=dcgan.architecture)
+        writer.save(str(tmpdir.join('DCGAN.model')), 1)
+        writer.close()
+        entry = manifest.find(dcgan.architecture)
+        shapes = dcgan.variable_shapes()
+        assert manifest.check(entry, shapes) is None
+
+        # Same size, different bytes: only the full hash notices
+        for data in tmpdir.visit('*.data-*'):
+            raw = bytearray(data.read_binary())
+            raw[-1] ^= 0xff
+            data.write_binary(bytes(raw))
+        assert Manifest(checkpoint_dir).check(entry, shapes) is None
+        assert 'changed' in manifest.check(entry, shapes)
+
+
+def test_failed_background_save_is_raised(tmpdir):
+    with tf.Graph().as_default(), tf.Session() as sess:
+        dcgan = small_dcgan(sess, str(tmpdir))
+        tf.global_variables_initializer().run()
+        writer = CheckpointWriter(sess, dcgan.saved_variables)
+        # The parent directory does not exist, the write fails
+        writer.save(str(tmpdir.join('missing', 'DCGAN.model')), 1)
+        with pytest.raises(Exception):
+            writer.close()
+        assert writer.saves == 0
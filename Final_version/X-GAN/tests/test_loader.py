@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from loader import EpochSampler
+
+
+def files(names):
+    return ['data/x/{}.jpg'.format(n) for n in names]
+
+
+def test_epoch_is_a_permutation_of_full_batches():
+    sampler = EpochSampler(files(range(10)), files(range(3)), 4, seed=0)
+    batches, batches2 = sampler.epoch()
+    assert [len(b) for b in batches] == [4, 4]
+    assert len(set(np.concatenate(batches))) == 8
+    # The shorter second stream wraps around
+    assert [len(b) for b in batches2] == [4, 4]
+    assert set(np.concatenate(batches2)) == set(range(3))
+
+
+def test_same_seed_same_epochs():
+    first = EpochSampler(files(range(10)), [], 2, seed=3, use_files2=False)
+    second = EpochSampler(files(range(10)), [], 2, seed=3, use_files2=False)
+    for _ in range(2):
+        a, _ = first.epoch()
+        b, _ = second.epoch()
+        assert np.array_equal(np.concatenate(a), np.concatenate(b))
+
+
+def test_without_shuffle_keeps_order_and_limit():
+    sampler = EpochSampler(files(range(10)), [], 3, shuffle=False,
+                           use_files2=False)
+    batches, _ = sampler.epoch(limit=7)
+    assert np.array_equal(np.concatenate(batches), np.arange(6))
+
+
+def test_empty_second_dataset_unused():
+    # --z_source noise never reads dataset2, which may not exist
+    sampler = EpochSampler(files(range(8)), [], 4, seed=0, use_files2=False)
+    batches, batches2 = sampler.epoch()
+    assert len(batches) == 2
+    assert batches2 == []
+
+
+def test_empty_second_dataset_used():
+    sampler = EpochSampler(files(range(8)), [], 4, seed=0)
+    with pytest.raises(ValueError):
+        sampler.epoch()
+
+
+def test_pair_by_name():
+    sampler = EpochSampler(files(['a', 'b', 'c', 'd']),
+                           files(['d', 'x', 'b', 'a']), 1, seed=1,
+                           pair_by_name=True, use_files2=False)
+    assert len(sampler) == 3
+    first = files(['a', 'b', 'c', 'd'])
+    second = files(['d', 'x', 'b', 'a'])
+    batches, batches2 = sampler.epoch()
+    for b, b2 in zip(batches, batches2):
+        assert first[b[0]] == second[b2[0]]
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from masks import make_masks
+
+SHAPE = (16, 16, 3)
+
+
+def test_center_mask():
+    masks = make_masks('center', 2, SHAPE)
+    assert masks.shape == (2,) + SHAPE
+    assert masks.dtype == np.float32
+    assert masks[0, 8, 8, 0] == 0. and masks[0, 0, 0, 0] == 1.
+    assert masks[:, 4:12, 4:12].sum() == 0
+    assert masks.sum() == 2 * (16 * 16 - 8 * 8) * 3
+
+
+def test_half_masks():
+    left, right = make_masks(['left', 'right'], 2, SHAPE)
+    assert left[:, :8].sum() == 0 and left[:, 8:].all()
+    assert right[:, 8:].sum() == 0 and right[:, :8].all()
+
+
+def test_specs_cycle_over_images():
+    masks = make_masks('full,center', 3, SHAPE)
+    assert masks[0].all() and masks[2].all()
+    assert not masks[1].all()
+
+
+def test_seeded_masks_repeat():
+    for spec in ['random:0.5', 'blocks:2', 'strokes:2']:
+        first = make_masks(spec, 4, SHAPE, seed=3)
+        assert np.array_equal(first, make_masks(spec, 4, SHAPE, seed=3))
+        assert not np.array_equal(first, make_masks(spec, 4, SHAPE, seed=4))
+        # Every channel of a pixel is masked alike
+        assert (first == first[..., :1]).all()
+
+
+def test_random_fraction():
+    masks = make_masks('random:0.3', 8, (64, 64, 1), seed=0)
+    assert abs(1. - masks.mean() - 0.3) < 0.02
+
+
+def test_deterministic_masks_cached_whatever_the_seed():
+    first = make_masks('center', 4, SHAPE, seed=1)
+    assert make_masks('center', 4, SHAPE, seed=2) is first
+    assert make_masks('center', 4, SHAPE) is first
+    assert not first.flags.writeable
+    assert make_masks('random', 4, SHAPE, seed=1) is not \
+        make_masks('random', 4, SHAPE, seed=1)
+
+
+def test_unknown_mask_type():
+    with pytest.raises(ValueError):
+        make_masks('square', 1, SHAPE)
@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pytest
+
+import mnist
+from mnist import MnistData, read_idx
+
+
+def write_idx(path, array):
+    array = np.asarray(array, dtype=np.uint8)
+    with open(path, 'wb') as f:
+        f.write(bytearray([0, 0, 0x08, array.ndim]))
+        f.write(np.array(array.shape, dtype='>i4').tobytes())
+        f.write(array.tobytes())
+
+
+@pytest.fixture
+def data_dir(tmpdir):
+    # 3 train and 2 test digits of 2x2 pixels, pixel values 10 * digit
+    labels = np.array([0, 1, 2, 3, 4])
+    images = np.repeat(labels * 10, 4).reshape([5, 2, 2])
+    (train_x, train_y), (test_x, test_y) = mnist.FILES
+    write_idx(str(tmpdir.join(train_x)), images[:3])
+    write_idx(str(tmpdir.join(train_y)), labels[:3])
+    write_idx(str(tmpdir.join(test_x)), images[3:])
+    write_idx(str(tmpdir.join(test_y)), labels[3:])
+    return str(tmpdir)
+
+
+def test_read_idx(data_dir):
+    images = read_idx(os.path.join(data_dir, mnist.FILES[0][0]))
+    assert images.shape == (3, 2, 2)
+    assert images[2, 1, 1] == 20
+
+
+def test_shuffled_images_and_labels_stay_together(data_dir):
+    data = MnistData(data_dir, cache=False)
+    assert len(data) == 5
+    assert data.x.shape == (5, 2, 2, 1)
+    order = np.random.RandomState(mnist.SEED).permutation(5)
+    assert list(data.y) == list(order)
+
+    images = data.images(0, 5)
+    assert images.dtype == np.float32
+    np.testing.assert_allclose(images[:, 0, 0, 0], data.y * 10 / 255.)
+    labels = data.labels(1, 3)
+    assert labels.shape == (2, 10)
+    assert list(labels.argmax(axis=1)) == list(data.y[1:3])
+
+
+def test_batches_into_buffers(data_dir):
+    data = MnistData(data_dir, cache=False)
+    images = np.zeros((4, 2, 2, 1), dtype=np.float32)
+    labels = np.zeros((2, 10), dtype=np.float32)
+    # The last batch is shorter than the buffer
+    batch = data.images(3, 5, out=images)
+    assert batch.shape == (2, 2, 2, 1) and np.shares_memory(batch, images)
+    data.labels(3, 5, out=labels)
+    assert list(labels.argmax(axis=1)) == list(data.y[3:5])
+
+
+def test_cache_is_reused(data_dir):
+    first = MnistData(data_dir)
+    assert os.path.exists(os.path.join(data_dir, mnist.CACHE_NAME))
+    for name, _ in mnist.FILES:
+        os.remove(os.path.join(data_dir, name))
+    second = MnistData(data_dir)
+    assert np.array_equal(first.x, second.x)
+    assert np.array_equal(first.y, second.y)
@@ -0,0 +1,35 @@
+import numpy as np
+
+from convergence import PlateauTracker
+
+
+def test_report_without_updates():
+    # nIter 0 never calls update
+    records = PlateauTracker(2, 1, 0, 0.).report(['a', 'b'])
+    assert [r['curve'] for r in records] == [[], []]
+    assert [r['loss'] for r in records] == [None, None]
+
+
+def test_report_keeps_last_iteration():
+    plateau = PlateauTracker(1, 2, 0, 0.)
+    plateau.update(0, np.array([3., 4.]))
+    plateau.update(49, np.array([5., 1.]))
+    record, = plateau.report(['a'])
+    assert record['curve'] == [[0, 3.], [49, 1.]]
+    assert record['loss'] == 1.
+
+
+def test_stops_once_every_image_plateaus():
+    plateau = PlateauTracker(2, 2, patience=2, tol=0.1)
+    # Slots 0-1 are image 0, 2-3 image 1. Image 1 never improves after
+    # iteration 0, image 0 last does at iteration 1
+    assert not plateau.update(0, np.array([4., 5., 8., 9.]))
+    assert not plateau.update(1, np.array([3., 5., 8., 9.]))
+    assert not plateau.update(2, np.array([3., 5., 8., 7.5]))
+    assert list(plateau.done) == [False, True]
+    assert list(plateau.frozen_slots()) == [False, False, True, True]
+    assert plateau.update(3, np.array([3., 5., 8., 9.]))
+    first, second = plateau.report(['a', 'b'])
+    assert (first['stopped_at'], second['stopped_at']) == (3, 2)
+    assert (first['loss'], second['loss']) == (3., 7.5)
+    assert first['last_improved'] == 1
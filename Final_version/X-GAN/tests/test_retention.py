@@ -0,0 +1,71 @@
+import pytest
+
+from checkpoints import Manifest, Retention
+
+
+def test_keep_last():
+    retention = Retention(keep_last=2)
+    assert retention.add('a', 1) == []
+    assert retention.add('b', 2) == []
+    assert retention.add('c', 3) == ['a']
+    assert retention.paths() == ['b', 'c']
+
+
+def test_keep_best_and_hourly():
+    retention = Retention(keep_last=1, keep_hours=1., keep_best=1)
+    retention.add('a', 1, metric=0.5, now=0.)
+    retention.add('b', 2, metric=0.1, now=600.)
+    retention.add('c', 3, metric=0.9, now=1200.)
+    # a is the first hourly one, b the best, c the last
+    assert retention.paths() == ['a', 'b', 'c']
+    assert retention.add('d', 4, metric=0.8, now=3600.) == ['c']
+    assert retention.paths() == ['a', 'b', 'd']
+
+
+def test_all_rules_disabled_keeps_everything():
+    retention = Retention(keep_last=0)
+    for step in range(10):
+        assert retention.add(str(step), step) == []
+    assert len(retention.paths()) == 10
+
+
+def write_checkpoint(tmpdir, name, data=b'data'):
+    tmpdir.join(name + '.index').write_binary(b'index')
+    tmpdir.join(name + '.data-00000-of-00001').write_binary(data)
+    return str(tmpdir.join(name))
+
+
+def test_manifest_finds_and_checks(tmpdir):
+    manifest = Manifest(str(tmpdir))
+    shapes = {'g/w': [2, 3]}
+    old = write_checkpoint(tmpdir, 'old-1')
+    manifest.add(old, 1, 'arch', {'dataset': 'a'}, shapes)
+    new = write_checkpoint(tmpdir, 'new-2')
+    manifest.add(new, 2, 'arch', {'dataset': 'b'}, shapes)
+
+    # The same dataset first, then the newest
+    assert manifest.find('arch', 'a')['step'] == 1
+    assert manifest.find('arch', 'c')['step'] == 2
+    assert [e['step'] for e in
+            manifest.candidates('arch', 'c', same_dataset=True)] == []
+    assert manifest.find('other') is None
+    with pytest.raises(ValueError):
+        manifest.require('other')
+
+    entry = manifest.find('arch', 'a')
+    assert manifest.check(entry, shapes) is None
+    assert 'model has no' in manifest.check(entry, {})
+    assert 'is [2, 3]' in manifest.check(entry, {'g/w': [3, 2]})
+    assert 'has no' in manifest.check(entry, dict(shapes, extra=[1]))
+
+    write_checkpoint(tmpdir, 'old-1', data=b'longer data')
+    assert 'changed' in manifest.check(entry, shapes)
+
+
+def test_manifest_drops_deleted_checkpoints(tmpdir):
+    manifest = Manifest(str(tmpdir))
+    prefix = write_checkpoint(tmpdir, 'model-1')
+    manifest.add(prefix, 1, 'arch', {}, {})
+    tmpdir.join('model-1.index').remove()
+    assert manifest.entries() == []
+    assert manifest.require('arch') is None
@@ -0,0 +1,77 @@
+import os
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+scipy_misc = pytest.importorskip('scipy.misc')
+
+from model import DCGAN
+
+
+class Config(object):
+    """The main.py flags train() reads, for a one step CPU run"""
+    dataset = 'a'
+    dataset2 = 'b'
+    epoch = 1
+    train_size = np.inf
+    batch_size = 4
+    learning_rate = 0.0002
+    beta1 = 0.5
+    checkpoint_dir = 'checkpoint'
+    sample_dir = 'samples'
+    loader_workers = 1
+    prefetch_batches = 1
+    loader_processes = False
+    trace_allocations = True
+    cache_file = ''
+    snapshot_queue = 2
+    snapshot_policy = 'block'
+    fused_step = False
+    summary_scalars = 1
+    summary_histograms = 1
+    summary_images = 1
+    num_towers = 2
+    tower_device = 'cpu'
+    shuffle = True
+    shuffle_seed = 0
+    pair_by_name = False
+    z_source = 'noise'
+    async_checkpoint = True
+    keep_checkpoints = 5
+    keep_checkpoint_hours = 0.
+    keep_best = 0
+    best_metric = 'g_loss'
+    verify_checkpoints = False
+
+
+def write_images(directory, n, size=8):
+    os.makedirs(directory)
+    rng = np.random.RandomState(0)
+    for i in range(n):
+        scipy_misc.imsave(os.path.join(directory, '{}.jpg'.format(i)),
+                          rng.randint(0, 256, (size, size, 3)).astype(np.uint8))
+
+
+def test_two_cpu_towers_train_one_step(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    config = Config()
+    write_images(os.path.join('data', config.dataset), config.batch_size)
+    write_images(os.path.join('data', config.dataset2), config.batch_size)
+    os.makedirs(config.checkpoint_dir)
+    os.makedirs(config.sample_dir)
+
+    session_config = tf.ConfigProto(allow_soft_placement=True)
+    session_config.device_count['CPU'] = config.num_towers
+    with tf.Graph().as_default(), tf.Session(config=session_config) as sess:
+        dcgan = DCGAN(sess, input_height=8, input_width=8, output_height=8,
+                      output_width=8, is_crop=False,
+                      batch_size=config.batch_size,
+                      sample_num=config.batch_size, gf_dim=4, df_dim=4,
+                      gfc_dim=16, dfc_dim=16, dataset_name=config.dataset,
+                      dataset_name2=config.dataset2,
+                      checkpoint_dir=config.checkpoint_dir, summaries=False)
+        dcgan.train(config)
+
+        # The one step is saved (counter 2) and found again
+        assert dcgan.load(config.checkpoint_dir) == (True, 2)
@@ -0,0 +1,42 @@
+import json
+import struct
+from collections import OrderedDict
+
+import numpy as np
+
+from weights import WeightFile, save_weights
+
+
+def test_round_trip(tmpdir):
+    path = str(tmpdir.join('model.safetensors'))
+    arrays = OrderedDict([
+        ('generator/g_h0_lin/Matrix', np.arange(6, dtype=np.float32)
+         .reshape([2, 3])),
+        ('generator/g_bn0/moving_mean', np.ones(3, dtype=np.float16)),
+        ('step', np.array([7], dtype=np.int64)),
+    ])
+    save_weights(path, arrays, {'step': 7, 'dataset': 'celebA'})
+
+    weights = WeightFile(path)
+    assert list(weights.arrays) == list(arrays)
+    assert weights.metadata == {'step': '7', 'dataset': 'celebA'}
+    for name, value in arrays.items():
+        assert name in weights
+        assert weights[name].dtype == value.dtype
+        np.testing.assert_array_equal(weights[name], value)
+    assert 'discriminator/d_h0_conv/w' not in weights
+    assert weights.nbytes() == sum(v.nbytes for v in arrays.values())
+
+
+def test_layout(tmpdir):
+    # 8 byte header size, JSON header padded to 8 bytes, then the data
+    path = str(tmpdir.join('small.safetensors'))
+    save_weights(path, {'a': np.array([1., 2.], dtype=np.float32)})
+    with open(path, 'rb') as f:
+        size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(size).decode('utf-8'))
+        data = f.read()
+    assert size % 8 == 0
+    assert header['a'] == {'dtype': 'F32', 'shape': [2],
+                           'data_offsets': [0, 8]}
+    assert np.frombuffer(data, dtype=np.float32).tolist() == [1., 2.]
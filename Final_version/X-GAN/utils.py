@@ -1,12 +1,16 @@
 from __future__ import division
+import io
+import os
 import math
 import json
 import random
-import scipy.misc
 import numpy as np
 from time import gmtime, strftime
 from six.moves import xrange
 
+# scipy.misc is imported by the functions that read or write images, so
+# importing the model does not load it
+
 
 try:
     import simplejson as json
@@ -17,12 +21,13 @@ except:
 Some codes from https://github.com/Newmu/dcgan_code
 """
 import tensorflow as tf
-import tensorflow.contrib.slim as slim
 
 get_stddev = lambda x, k_h, k_w: 1 / math.sqrt(k_w * k_h * x.get_shape()[-1])
 
 
 def show_all_variables():
+    # slim is slow to import and only needed here
+    import tensorflow.contrib.slim as slim
     model_vars = tf.trainable_variables()
     slim.model_analyzer.analyze_vars(model_vars, print_info=True)
 
@@ -35,17 +40,102 @@ def get_image(image_path, input_height, input_width,
                      resize_height, resize_width, is_crop)
 
 
-def save_images(images, size, image_path):
-    return imsave(inverse_transform(images), size, image_path)
-
-# Overloading Method
+def decode_image(data, input_height, input_width,
+                 resize_height=64, resize_width=64,
+                 is_crop=True, is_grayscale=False):
+    # Same as get_image, for encoded image bytes instead of a path
+    image = imread(io.BytesIO(data), is_grayscale)
+    return transform(image, input_height, input_width,
+                     resize_height, resize_width, is_crop)
 
 
-def save_images_inpaint(images, size, image_path):
-    return imsave_inpaint(inverse_transform(images), size, image_path)
+def encode_png(image):
+    import scipy.misc
+    image = np.clip(inverse_transform(np.squeeze(image)) * 255., 0, 255)
+    buf = io.BytesIO()
+    scipy.misc.toimage(image.astype(np.uint8), cmin=0, cmax=255).save(
+        buf, format='PNG')
+    return buf.getvalue()
+
+
+def save_images(images, size, image_path, padding=0):
+    return imsave(inverse_transform(images), size, image_path, padding)
+
+
+def completed_path(outDir, image_file):
+    # One completed image per input file, named after it
+    name = os.path.splitext(os.path.basename(image_file))[0]
+    return os.path.join(outDir, 'completed', name + '.png')
+
+
+def append_records(path, records):
+    # JSON lines, one record per inpainted image
+    with open(path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+def save_completed(image, path, records_path, record):
+    # The image goes to its final name only once it is fully written and
+    # its record follows it, so a failed write leaves neither and a
+    # resumed run inpaints the image again
+    stem, ext = os.path.splitext(path)
+    tmp = stem + '.tmp' + ext
+    save_images(image[None], [1, 1], tmp)
+    os.replace(tmp, path)
+    append_records(records_path, [record])
+
+
+class InpaintSnapshot(object):
+    """Progress grids of one inpainting batch. Every image takes `restarts`
+    consecutive slots, only its currently best slot is shown. Grid names
+    start with `prefix`, with `grids` False only the loss is logged."""
+
+    def __init__(self, outDir, masked_images, batch_mask, batchSz, restarts,
+                 log, writer, prefix='', grids=True):
+        self.outDir = outDir
+        self.prefix = prefix
+        self.grids = grids
+        self.masked_images = masked_images
+        self.batch_mask = batch_mask
+        self.batchSz = batchSz
+        self.restarts = restarts
+        self.firsts = np.arange(batchSz) * restarts
+        self.log = log
+        self.writer = writer
+
+    def pick(self, slot_loss):
+        nSlots = self.batchSz * self.restarts
+        return self.firsts + slot_loss[:nSlots].reshape(
+            [self.batchSz, self.restarts]).argmin(axis=1)
+
+    def save(self, i, loss, ctx_loss, G_imgs):
+        pick = self.pick(ctx_loss)
+        inpaint_loss = np.mean(loss[pick])
+        print('Inpainting Epoch: {}           Inpainting Loss: {}'.format(
+            i, inpaint_loss))
+        self.log.append({i: inpaint_loss})
+        if not self.grids:
+            return
+
+        nRows = np.ceil(self.batchSz / 8)
+        nCols = 8
+        imgName = os.path.join(self.outDir, 'hats_imgs/{}{:04d}.png'.format(
+            self.prefix, i))
+        self.writer.submit(save_images, G_imgs[pick],
+                           [nRows, nCols], imgName)
+
+        inv_masked_hat_images = np.multiply(
+            G_imgs[pick], 1.0 - self.batch_mask[pick])
+        completeed = self.masked_images[pick] + inv_masked_hat_images
+        imgName = os.path.join(self.outDir, 'inpainted/{}{:04d}.png'.format(
+            self.prefix, i))
+        self.writer.submit(save_images, completeed,
+                           [nRows, nCols], imgName)
 
 
 def imread(path, is_grayscale=False):
+    import scipy.misc
     if (is_grayscale):
         return scipy.misc.imread(path, flatten=True).astype(np.float)
     else:
@@ -56,66 +146,49 @@ def merge_images(images, size):
     return inverse_transform(images)
 
 
-def merge(images, size):
-    h, w = images.shape[1], images.shape[2]
-    if (images.shape[3] in (3, 4)):
-        c = images.shape[3]
-        img = np.zeros((h * size[0], w * size[1], c))
-        for idx, image in enumerate(images):
-            i = idx % size[1]
-            j = idx // size[1]
-            img[j * h:j * h + h, i * w:i * w + w, :] = image
-        return img
-    elif images.shape[3] == 1:
-        img = np.zeros((h * size[0], w * size[1]))
-        for idx, image in enumerate(images):
-            i = idx % size[1]
-            j = idx // size[1]
-            img[j * h:j * h + h, i * w:i * w + w] = image[:, :, 0]
-        return img
-    else:
-        raise ValueError('in merge(images,size) images parameter '
-                         'must have dimensions: HxW or HxWx3 or HxWx4')
+def merge(images, size, padding=0, pad_value=0):
+    """Tile `images` (NxHxWxC or NxHxW) into a size[0] x size[1] grid.
 
-# Overloading Method
-
-
-def merge_inpaint(images, size):
-    h, w = images.shape[1], images.shape[2]
-    if (images.shape[3] in (3, 4)):
-        c = images.shape[3]
-        img = np.zeros((int(h * size[0]), int(w * size[1]), c))
-        for idx, image in enumerate(images):
-            i = idx % size[1]
-            j = idx // size[1]
-            img[j * h:j * h + h, i * w:i * w + w, :] = image
-        return img
-    elif images.shape[3] == 1:
-        img = np.zeros((int(h * size[0]), int(w * size[1])))
-        for idx, image in enumerate(images):
-            i = idx % size[1]
-            j = idx // size[1]
-            img[j * h:j * h + h, i * w:i * w + w] = image[:, :, 0]
-        return img
-    else:
+    The tiling is a single reshape/transpose in the dtype of `images`.
+    `padding` pixels of `pad_value` separate neighbouring tiles and missing
+    tiles are left as `pad_value`. Single channel grids are returned as HxW.
+    """
+    images = np.asarray(images)
+    if images.ndim == 3:
+        images = images[:, :, :, None]
+    if images.ndim != 4 or images.shape[3] not in (1, 3, 4):
         raise ValueError('in merge(images,size) images parameter '
                          'must have dimensions: HxW or HxWx3 or HxWx4')
+    n, h, w, c = images.shape
+    rows, cols = int(size[0]), int(size[1])
+    n = min(n, rows * cols)
+
+    if n < rows * cols or padding:
+        tiles = np.full((rows * cols, h + padding, w + padding, c),
+                        pad_value, dtype=images.dtype)
+        tiles[:n, :h, :w] = images[:n]
+    else:
+        tiles = images[:n]
+    th, tw = tiles.shape[1:3]
 
-# Overloading Method
-
-
-def imsave_inpaint(images, size, path):
-    image = np.squeeze(merge_inpaint(images, size))
-    return scipy.misc.imsave(path, image)
+    img = tiles.reshape([rows, cols, th, tw, c]).transpose(
+        [0, 2, 1, 3, 4]).reshape([rows * th, cols * tw, c])
+    if padding:
+        img = img[:-padding, :-padding]
+    if c == 1:
+        img = img[:, :, 0]
+    return img
 
 
-def imsave(images, size, path):
-    image = np.squeeze(merge(images, size))
+def imsave(images, size, path, padding=0):
+    import scipy.misc
+    image = np.squeeze(merge(images, size, padding))
     return scipy.misc.imsave(path, image)
 
 
 def center_crop(x, crop_h, crop_w,
                 resize_h=64, resize_w=64):
+    import scipy.misc
     if crop_w is None:
         crop_w = crop_h
     h, w = x.shape[:2]
@@ -127,6 +200,7 @@ def center_crop(x, crop_h, crop_w,
 
 def transform(image, input_height, input_width,
               resize_height=64, resize_width=64, is_crop=True):
+    import scipy.misc
     if is_crop:
         cropped_image = center_crop(
             image, input_height, input_width,
@@ -0,0 +1,74 @@
+import os
+import json
+import struct
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+# Flat weight files for inference
+# The layout of a .safetensors file: an 8 byte little-endian header size,
+# a JSON header with the dtype, shape and byte range of every array, then
+# the raw array data. Reading one memory-maps the file, the arrays are
+# views into it and nothing is copied until they are assigned.
+
+DTYPES = {'F64': np.float64, 'F32': np.float32, 'F16': np.float16,
+          'I64': np.int64, 'I32': np.int32, 'U8': np.uint8}
+CODES = dict((np.dtype(v), k) for k, v in DTYPES.items())
+
+
+def save_weights(path, arrays, metadata=None):
+    """Writes `arrays` (a dict or (name, array) pairs, kept in order) and
+    `metadata` (stored as strings) to `path`"""
+    arrays = OrderedDict(arrays)
+    header = OrderedDict()
+    if metadata:
+        header['__metadata__'] = dict(
+            (str(k), str(v)) for k, v in metadata.items())
+    offset = 0
+    for name, value in arrays.items():
+        value = np.asarray(value)
+        header[name] = {'dtype': CODES[value.dtype],
+                        'shape': list(value.shape),
+                        'data_offsets': [offset, offset + value.nbytes]}
+        offset += value.nbytes
+
+    # Padded so the data starts 8 byte aligned
+    encoded = json.dumps(header).encode('utf-8')
+    encoded += b' ' * (-len(encoded) % 8)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(struct.pack('<Q', len(encoded)))
+        f.write(encoded)
+        for value in arrays.values():
+            f.write(np.ascontiguousarray(value).tobytes())
+    os.replace(tmp, path)
+
+
+class WeightFile(object):
+    """Memory-mapped arrays of a file written by save_weights"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            size = struct.unpack('<Q', f.read(8))[0]
+            header = json.loads(f.read(size).decode('utf-8'))
+        self.path = path
+        self.metadata = header.pop('__metadata__', {})
+        self.data = np.memmap(path, dtype=np.uint8, mode='r', offset=8 + size)
+
+        self.arrays = OrderedDict()
+        for name, info in header.items():
+            begin, end = info['data_offsets']
+            self.arrays[name] = self.data[begin:end] \
+                .view(DTYPES[info['dtype']]).reshape(info['shape'])
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def nbytes(self):
+        return self.data.nbytes
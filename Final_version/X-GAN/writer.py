@@ -0,0 +1,92 @@
+import atexit
+import threading
+from six.moves import queue
+
+# Background writer for sample and inpainting snapshots
+# Grid assembly and PNG encoding run on a worker thread instead of between
+# two sess.run calls. Arrays handed to `submit` must not be modified
+# afterwards, they are written as they are when the worker gets to them.
+
+
+class SnapshotWriter(object):
+    """Runs `fn(*args)` jobs in order on a background thread.
+
+    At most `max_queue` jobs wait at a time. When the queue is full the
+    'block' policy waits for room and the 'drop' policy skips the snapshot.
+    A `max_queue` of 0 writes synchronously. Pending jobs are flushed by
+    `close`, which also runs at interpreter exit.
+    """
+
+    def __init__(self, max_queue=8, policy='block'):
+        assert(policy in ('block', 'drop'))
+        self.policy = policy
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.synchronous = max_queue <= 0
+        self.closed = False
+
+        if not self.synchronous:
+            self._queue = queue.Queue(maxsize=max_queue)
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.close)
+
+    def _write(self, fn, args):
+        try:
+            fn(*args)
+            self.written += 1
+        except Exception as e:
+            # The rest of a failed job (e.g. its result record) is skipped
+            self.failed += 1
+            print(" [!] Snapshot write failed: {}".format(e))
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                break
+            self._write(*job)
+            self._queue.task_done()
+
+    def submit(self, fn, *args):
+        if self.synchronous:
+            self._write(fn, args)
+            return True
+        if self.policy == 'drop':
+            try:
+                self._queue.put_nowait((fn, args))
+            except queue.Full:
+                self.dropped += 1
+                return False
+        else:
+            self._queue.put((fn, args))
+        return True
+
+    def submit_always(self, fn, *args):
+        # For outputs that must not be dropped, waits for room under
+        # either policy
+        if self.synchronous:
+            self._write(fn, args)
+        else:
+            self._queue.put((fn, args))
+        return True
+
+    def flush(self):
+        if not self.synchronous:
+            self._queue.join()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if not self.synchronous:
+            self._queue.put(None)
+            self._thread.join()
+        if self.dropped:
+            print(" [*] Dropped {} snapshots, writer queue was full".format(
+                self.dropped))
+        if self.failed:
+            print(" [!] {} snapshot writes failed".format(self.failed))